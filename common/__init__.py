@@ -1,2 +1,6 @@
 from main import *
 from level_logger import *
+from timer_scheduler import *
+from cron_schedule import *
+from process_executor import *
+from send_queue import *
@@ -0,0 +1,191 @@
+from datetime import datetime, timedelta
+import bisect, time
+
+MONTH_NAMES = dict( ( name, number + 1 ) for number, name in enumerate( [ 'jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec' ] ) )
+WEEKDAY_NAMES = dict( ( name, number ) for number, name in enumerate( [ 'sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat' ] ) )
+
+SCHEDULE_ALIASES = { '@yearly': '0 0 1 1 *',
+                     '@annually': '0 0 1 1 *',
+                     '@monthly': '0 0 1 * *',
+                     '@weekly': '0 0 * * * sun',
+                     '@daily': '0 0 * * *',
+                     '@hourly': '0 * * * *',
+                   }
+
+# how far past the last allowed year, or past the start when any year is
+# allowed, nextTime looks before deciding a schedule never fires; 28 years is
+# a full cycle of leap years and weekdays
+SEARCH_YEARS = 28
+
+class CronScheduleException( Exception ):
+    pass
+
+class CronSchedule( object ):
+    """
+    A compiled schedule of the form
+
+        minute hour day month year [weekday]
+
+    where each field is '*' or a comma separated list of values and ranges
+    ('a-b'), each optionally followed by a step ('*/15', '1-31/2'). Months and
+    weekdays also accept their three letter english names and weekdays count
+    from 0 (or 7) for sunday. When both day and weekday are restricted, a day
+    matching either of them matches, as with cron.
+
+    Each field is compiled to a sorted list of allowed values, or None when any
+    value is allowed, so the next matching minute is found by jumping field by
+    field instead of scanning minutes.
+    """
+
+    def __init__( self, schedule ):
+        self.schedule = schedule
+        fields = SCHEDULE_ALIASES.get( schedule.strip().lower(), schedule ).split()
+
+        if len( fields ) == 5:
+            fields.append( '*' )
+
+        if len( fields ) != 6:
+            raise CronScheduleException( 'invalid schedule: %s' % schedule )
+
+        self.minutes = parseField( fields[0], 0, 59 )
+        self.hours = parseField( fields[1], 0, 23 )
+        self.days = parseField( fields[2], 1, 31 )
+        self.months = parseField( fields[3], 1, 12, MONTH_NAMES )
+        self.years = parseField( fields[4], 1970, 9999 )
+        self.weekdays = parseField( fields[5], 0, 7, WEEKDAY_NAMES )
+
+        if self.weekdays is not None:
+            self.weekdays = sorted( set( weekday % 7 for weekday in self.weekdays ) )
+
+    def __repr__( self ):
+        return 'CronSchedule(%r)' % self.schedule
+
+    def matchesDay( self, when ):
+        day_match = self.days is None or when.day in self.days
+        weekday_match = self.weekdays is None or ( when.weekday() + 1 ) % 7 in self.weekdays
+
+        if self.days is not None and self.weekdays is not None:
+            return day_match or weekday_match
+
+        return day_match and weekday_match
+
+    def nextTime( self, after ):
+        """
+        Return the first naive local datetime strictly after the minute of after
+        that matches the schedule, or None if the schedule never fires again.
+        """
+        when = after.replace( second = 0, microsecond = 0 ) + timedelta( minutes = 1 )
+
+        if self.years:
+            last_year = self.years[-1]
+        else:
+            last_year = when.year + SEARCH_YEARS
+
+        while when.year <= last_year:
+
+            if self.years is not None and not when.year in self.years:
+                year = nextValue( self.years, when.year )
+                if year is None:
+                    return None
+                when = datetime( year, 1, 1 )
+                continue
+
+            if self.months is not None and not when.month in self.months:
+                month = nextValue( self.months, when.month )
+                if month is None:
+                    when = datetime( when.year + 1, 1, 1 )
+                else:
+                    when = datetime( when.year, month, 1 )
+                continue
+
+            if not self.matchesDay( when ):
+                when = datetime( when.year, when.month, when.day ) + timedelta( days = 1 )
+                continue
+
+            if self.hours is not None and not when.hour in self.hours:
+                hour = nextValue( self.hours, when.hour )
+                if hour is None:
+                    when = datetime( when.year, when.month, when.day ) + timedelta( days = 1 )
+                else:
+                    when = when.replace( hour = hour, minute = 0 )
+                continue
+
+            if self.minutes is not None and not when.minute in self.minutes:
+                minute = nextValue( self.minutes, when.minute )
+                if minute is None:
+                    when = when.replace( minute = 0 ) + timedelta( hours = 1 )
+                else:
+                    when = when.replace( minute = minute )
+                continue
+
+            return when
+
+        return None
+
+    @staticmethod
+    def toTimestamp( when ):
+        """
+        Convert a naive local datetime to a timestamp. Local times skipped by a
+        daylight saving change are moved forward by the size of the change and
+        local times repeated by one are only returned once, by nextTime.
+        """
+        return time.mktime( when.timetuple() )
+
+def nextValue( values, value ):
+    """
+    Return the first of the sorted values greater than value, or None.
+    """
+    index = bisect.bisect_right( values, value )
+
+    if index == len( values ):
+        return None
+
+    return values[ index ]
+
+def parseField( field, minimum, maximum, names = None ):
+    """
+    Compile a single schedule field to a sorted list of allowed values, or None
+    when any value between minimum and maximum is allowed.
+    """
+    if field == '*':
+        return None
+
+    values = set()
+    for item in field.lower().split( ',' ):
+        step = 1
+        if '/' in item:
+            item, step = item.split( '/', 1 )
+            step = parseValue( step, 1, maximum - minimum + 1 )
+
+        if item == '*':
+            first, last = minimum, maximum
+        elif '-' in item:
+            first, last = item.split( '-', 1 )
+            first = parseValue( first, minimum, maximum, names )
+            last = parseValue( last, minimum, maximum, names )
+        else:
+            first = parseValue( item, minimum, maximum, names )
+            last = first
+            if step != 1:
+                last = maximum
+
+        if first > last:
+            raise CronScheduleException( 'invalid range: %s' % field )
+
+        values.update( range( first, last + 1, step ) )
+
+    return sorted( values )
+
+def parseValue( value, minimum, maximum, names = None ):
+    if names and value in names:
+        return names[ value ]
+
+    try:
+        number = int( value )
+    except ValueError:
+        raise CronScheduleException( 'invalid value: %s' % value )
+
+    if number < minimum or number > maximum:
+        raise CronScheduleException( 'value out of range: %s' % value )
+
+    return number
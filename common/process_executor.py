@@ -0,0 +1,178 @@
+from twisted.internet import reactor, protocol, defer, error
+from twisted.python import log
+from twisted.python.procutils import which
+import collections, logging, os, signal
+
+class ProcessExecutorException( Exception ):
+    pass
+
+class ProcessExecutorQueueFull( ProcessExecutorException ):
+    pass
+
+class ProcessResult( object ):
+
+    def __init__( self, exit_code, signal, stdout, stderr, timed_out, truncated ):
+        self.exit_code = exit_code
+        self.signal = signal
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        self.truncated = truncated
+
+    def succeeded( self ):
+        return self.exit_code == 0 and not self.timed_out
+
+class OutputCollectorProtocol( protocol.ProcessProtocol ):
+    """
+    Collects up to max_output bytes of stdout and of stderr. Anything past that
+    is still read, so the child never blocks on a full pipe, but discarded.
+    """
+
+    def __init__( self, deferred, max_output ):
+        self.deferred = deferred
+        self.max_output = max_output
+        self.output = { 1: [], 2: [] }
+        self.output_size = { 1: 0, 2: 0 }
+        self.truncated = False
+        self.timed_out = False
+        self.ended = False
+        self.process_group = False
+        self.pid = None
+
+    def connectionMade( self ):
+        # the transport forgets the pid once the process is reaped
+        self.pid = self.transport.pid
+        self.transport.closeStdin()
+
+    def childDataReceived( self, fd, data ):
+        if not fd in self.output:
+            return
+
+        room = self.max_output - self.output_size[ fd ]
+
+        if len( data ) > room:
+            self.truncated = True
+            data = data[ :max( room, 0 ) ]
+
+        if data:
+            self.output[ fd ].append( data )
+            self.output_size[ fd ] += len( data )
+
+    def processEnded( self, reason ):
+        self.ended = True
+
+        exit_code = getattr( reason.value, 'exitCode', None )
+        signal = getattr( reason.value, 'signal', None )
+
+        self.deferred.callback( ProcessResult( exit_code, signal, ''.join( self.output[1] ), ''.join( self.output[2] ), self.timed_out, self.truncated ) )
+
+class ProcessExecutor( object ):
+    """
+    Runs external commands with reactor.spawnProcess, so no thread is held
+    while they run.
+
+    At most max_running commands run at once; up to max_queued more wait for a
+    free slot and any beyond that fail with ProcessExecutorQueueFull. A command
+    still running after its timeout is sent SIGTERM and, kill_grace seconds
+    later, SIGKILL, and our ends of its pipes are closed.
+
+    Commands are started in a session of their own with setsid, when it is
+    installed, so the signals reach every process they started, such as the
+    commands of a shell.
+    """
+    setsid_path = ( which( 'setsid' ) or [ None ] )[0]
+
+    def __init__( self, max_running = 4, max_queued = 100, kill_grace = 5, clock = reactor ):
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.kill_grace = kill_grace
+        self.clock = clock
+        self.running = 0
+        self.queue = collections.deque()
+
+        if self.setsid_path is None:
+            log.msg( 'ProcessExecutor: setsid not found, timeouts only signal the command itself' )
+
+    def execute( self, args, timeout = 300, max_output = 65536, env = None, path = None ):
+        """
+        Returns a deferred firing with the ProcessResult of running args.
+        """
+        d = defer.Deferred()
+
+        if self.running < self.max_running:
+            self.start( d, args, timeout, max_output, env, path )
+        elif len( self.queue ) >= self.max_queued:
+            log.msg( 'ProcessExecutor: queue full, refusing %s' % ( args, ), level = logging.DEBUG )
+            return defer.fail( ProcessExecutorQueueFull( args ) )
+        else:
+            self.queue.append( ( d, args, timeout, max_output, env, path ) )
+
+        return d
+
+    def start( self, d, args, timeout, max_output, env, path ):
+        self.running += 1
+
+        process_deferred = defer.Deferred()
+        process_protocol = OutputCollectorProtocol( process_deferred, max_output )
+
+        if env is None:
+            env = os.environ
+
+        if self.setsid_path:
+            args = [ self.setsid_path ] + list( args )
+            process_protocol.process_group = True
+
+        try:
+            reactor.spawnProcess( process_protocol, args[0], args, env = env, path = path )
+        except:
+            process_deferred.errback()
+        else:
+            timeout_call = self.clock.callLater( timeout, self.terminate, process_protocol )
+            process_deferred.addBoth( self.cancelTimeout, timeout_call )
+
+        process_deferred.addBoth( self.processDone ).chainDeferred( d )
+
+    def cancelTimeout( self, response, timeout_call ):
+        if timeout_call.active():
+            timeout_call.cancel()
+
+        return response
+
+    def terminate( self, process_protocol ):
+        log.msg( 'ProcessExecutor: process timed out', level = logging.DEBUG )
+        process_protocol.timed_out = True
+        self.signal( process_protocol, 'TERM' )
+
+        # children of the command may still hold the pipes open, which would
+        # keep processEnded from firing
+        if not process_protocol.ended:
+            process_protocol.transport.loseConnection()
+
+        self.clock.callLater( self.kill_grace, self.signal, process_protocol, 'KILL' )
+
+    def signal( self, process_protocol, signal_name ):
+        # the process group outlives its leader while any of its other
+        # processes run
+        if process_protocol.process_group:
+            try:
+                os.killpg( process_protocol.pid, getattr( signal, 'SIG' + signal_name ) )
+            except OSError:
+                pass
+
+            return
+
+        if process_protocol.ended:
+            return
+
+        try:
+            process_protocol.transport.signalProcess( signal_name )
+        except error.ProcessExitedAlready:
+            pass
+
+    def processDone( self, response ):
+        self.running -= 1
+
+        while self.queue and self.running < self.max_running:
+            self.start( *self.queue.popleft() )
+
+        return response
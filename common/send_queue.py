@@ -0,0 +1,293 @@
+from twisted.internet import reactor
+from twisted.python import log
+import collections, logging
+
+class SendQueueException( Exception ):
+    pass
+
+class TokenBucket( object ):
+    """
+    Allows rate sends a second on average, in bursts of up to burst sends.
+    """
+    __slots__ = ( 'rate', 'burst', 'tokens', 'updated' )
+
+    # refilling for exactly delay() seconds can fall short of a whole token by
+    # a rounding error
+    epsilon = 1e-9
+
+    def __init__( self, rate, burst, now ):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill( self, now ):
+        self.tokens = min( self.burst, self.tokens + ( now - self.updated ) * self.rate )
+        self.updated = now
+
+    def ready( self, now ):
+        self.refill( now )
+        return self.tokens + self.epsilon >= 1
+
+    def take( self ):
+        self.tokens -= 1
+
+    def delay( self, now ):
+        """
+        Return the seconds until a send is allowed.
+        """
+        self.refill( now )
+        return max( 0, ( 1 - self.tokens ) / self.rate )
+
+    def full( self, now ):
+        self.refill( now )
+        return self.tokens >= self.burst
+
+class SendQueue( object ):
+    """
+    Sends stanzas on an xmlstream no faster than a token bucket for the
+    connection, one for each recipient and one for each MUC room allow; a rate
+    of 0 removes a limit. Stanzas of a higher priority go first, unless all of
+    their destinations are held back by their own limits, and destinations of
+    the same priority take turns.
+
+    Stanzas sent while there is no xmlstream are kept until there is one. At
+    most max_size stanzas wait; past that a new stanza replaces the oldest
+    waiting one of a lower priority, or is dropped when there is none.
+
+    With room_ready, a function telling whether we are in a room, stanzas to
+    a room we are not in, as after a reconnect until the room is joined again,
+    are held and checked again every room_check_interval seconds; those held
+    for more than room_hold_timeout seconds are dropped.
+    """
+    priorities = [ 'high', 'normal', 'low' ]
+    counters = [ 'queued', 'sent', 'dropped', 'pending', 'wait_average', 'wait_max' ]
+    prune_minimum = 64
+    room_check_interval = 1.0
+    room_hold_timeout = 300
+
+    def __init__( self, rate = 5, burst = 10, recipient_rate = 1, recipient_burst = 5, room_rate = 1, room_burst = 5, max_size = 1000, room_ready = None, clock = reactor ):
+        self.clock = clock
+        self.max_size = max_size
+        self.room_ready = room_ready
+        self.xmlstream = None
+        self.delayed_call = None
+
+        # one ordered dict of destination -> deque of ( element, queued at )
+        # per priority
+        self.levels = [ collections.OrderedDict() for priority in self.priorities ]
+        self.size = 0
+        self.buckets = {}
+
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+        self.setLimits( rate, burst, recipient_rate, recipient_burst, room_rate, room_burst )
+
+    def setLimits( self, rate, burst, recipient_rate, recipient_burst, room_rate, room_burst ):
+        for limit in [ rate, burst, recipient_rate, recipient_burst, room_rate, room_burst ]:
+            if limit < 0:
+                raise SendQueueException( 'invalid send limits' )
+
+        self.limits = { 'connection': ( rate, max( burst, 1 ) ),
+                        'recipient': ( recipient_rate, max( recipient_burst, 1 ) ),
+                        'room': ( room_rate, max( room_burst, 1 ) ),
+                      }
+        self.buckets.clear()
+
+    def connected( self, xmlstream ):
+        self.xmlstream = xmlstream
+        self.pump()
+
+    def disconnected( self ):
+        self.xmlstream = None
+
+        if self.delayed_call and self.delayed_call.active():
+            self.delayed_call.cancel()
+
+        self.delayed_call = None
+
+    def send( self, element, recipient = None, room = False, priority = 'normal' ):
+        """
+        Queue element, a domish element or a serialized stanza, for recipient,
+        a bare JID string, which is a MUC room when room is set. Returns False
+        when the element was dropped.
+        """
+        if not priority in self.priorities:
+            raise SendQueueException( 'invalid priority %s' % priority )
+
+        level = self.priorities.index( priority )
+
+        if self.size >= self.max_size and not self.evict( level ):
+            log.msg( 'SendQueue: queue full, dropping stanza to %s' % recipient, level = logging.DEBUG )
+            self.dropped += 1
+            return False
+
+        if room:
+            destination = ( 'room', recipient )
+        else:
+            destination = ( 'recipient', recipient )
+
+        if not destination in self.levels[ level ]:
+            self.levels[ level ][ destination ] = collections.deque()
+
+        self.levels[ level ][ destination ].append( ( element, self.clock.seconds() ) )
+        self.size += 1
+        self.queued += 1
+
+        self.pump()
+        return True
+
+    def evict( self, level ):
+        """
+        Drop the oldest waiting stanza of the lowest priority below level.
+        """
+        for lower in range( len( self.levels ) - 1, level, -1 ):
+            if not self.levels[ lower ]:
+                continue
+
+            destination, entries = next( self.levels[ lower ].iteritems() )
+            entries.popleft()
+
+            if not entries:
+                del self.levels[ lower ][ destination ]
+
+            log.msg( 'SendQueue: queue full, dropping oldest %s stanza' % self.priorities[ lower ], level = logging.DEBUG )
+            self.size -= 1
+            self.dropped += 1
+            return True
+
+        return False
+
+    def getBucket( self, destination ):
+        """
+        Return the token bucket of destination, or None when it is not
+        limited.
+        """
+        if destination in self.buckets:
+            return self.buckets[ destination ]
+
+        rate, burst = self.limits[ destination[0] ]
+
+        if not rate:
+            return None
+
+        bucket = TokenBucket( rate, burst, self.clock.seconds() )
+        self.buckets[ destination ] = bucket
+        return bucket
+
+    def pump( self ):
+        """
+        Send whatever the limits allow now and call again once they allow
+        more.
+        """
+        if self.delayed_call and self.delayed_call.active():
+            self.delayed_call.cancel()
+
+        self.delayed_call = None
+
+        if self.xmlstream is None:
+            return
+
+        now = self.clock.seconds()
+        connection = self.getBucket( ( 'connection', None ) )
+        wait = None
+
+        while self.size:
+            if connection and not connection.ready( now ):
+                wait = connection.delay( now )
+                break
+
+            level, destination, wait = self.nextDestination( now )
+
+            if destination is None:
+                break
+
+            entries = level.pop( destination )
+            element, queued_at = entries.popleft()
+
+            # move the destination to the back, so the others get their turn
+            if entries:
+                level[ destination ] = entries
+
+            bucket = self.getBucket( destination )
+            if bucket:
+                bucket.take()
+
+            if connection:
+                connection.take()
+
+            self.size -= 1
+            self.sent += 1
+            self.wait_total += now - queued_at
+            self.wait_max = max( self.wait_max, now - queued_at )
+
+            self.xmlstream.send( element )
+
+        if self.size:
+            self.delayed_call = self.clock.callLater( wait, self.pump )
+        elif len( self.buckets ) > self.prune_minimum:
+            for destination, bucket in self.buckets.items():
+                if bucket.full( now ):
+                    del self.buckets[ destination ]
+
+    def nextDestination( self, now ):
+        """
+        Return the level and destination of the next stanza to send, or None
+        and the seconds until a waiting destination is allowed to send again.
+        """
+        wait = None
+
+        for level in self.levels:
+            # a copy, as held destinations may be dropped
+            for destination in level.keys():
+                if destination[0] == 'room' and self.room_ready and not self.room_ready( destination[1] ):
+                    self.expire( level, destination, now )
+                    delay = self.room_check_interval
+                else:
+                    bucket = self.getBucket( destination )
+
+                    if bucket is None or bucket.ready( now ):
+                        return level, destination, 0
+
+                    delay = bucket.delay( now )
+
+                if wait is None or delay < wait:
+                    wait = delay
+
+        return None, None, wait
+
+    def expire( self, level, destination, now ):
+        """
+        Drop the stanzas of a held destination that waited too long.
+        """
+        entries = level[ destination ]
+
+        while entries and now - entries[0][1] > self.room_hold_timeout:
+            entries.popleft()
+            self.size -= 1
+            self.dropped += 1
+
+        if not entries:
+            log.msg( 'SendQueue: not in room %s, dropped its stanzas' % destination[1], level = logging.DEBUG )
+            del level[ destination ]
+
+    def getStats( self ):
+        stats = { 'queued': self.queued,
+                  'sent': self.sent,
+                  'dropped': self.dropped,
+                  'pending': self.size,
+                  'wait_average': 0.0,
+                  'wait_max': self.wait_max,
+                }
+
+        if self.sent:
+            stats[ 'wait_average' ] = self.wait_total / self.sent
+
+        for priority, level in zip( self.priorities, self.levels ):
+            stats[ 'pending_' + priority ] = sum( len( entries ) for entries in level.itervalues() )
+
+        return stats
@@ -0,0 +1,132 @@
+from twisted.internet import reactor
+from twisted.python import log
+import heapq, itertools, logging
+
+class TimerSchedulerException( Exception ):
+    pass
+
+class ScheduledCall( object ):
+
+    def __init__( self, scheduler, when, func, args, kwargs ):
+        self.scheduler = scheduler
+        self.when = when
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+        self.called = False
+        self.in_heap = True
+
+    def active( self ):
+        return not ( self.cancelled or self.called )
+
+    def cancel( self ):
+        self.scheduler.cancel( self )
+
+class TimerScheduler( object ):
+    """
+    Keeps any number of timed calls on a heap ordered by due time and drives
+    them all with a single reactor.callLater for the earliest one.
+
+    Cancelled calls are only marked and are skipped when they reach the top of
+    the heap; the heap is compacted once more than half of it is cancelled.
+    """
+    compact_minimum = 64
+
+    def __init__( self, clock = reactor ):
+        self.clock = clock
+        self.heap = []
+        self.counter = itertools.count()
+        self.cancelled = 0
+        self.delayed_call = None
+
+    def __len__( self ):
+        return len( self.heap ) - self.cancelled
+
+    def seconds( self ):
+        return self.clock.seconds()
+
+    def callAt( self, when, func, *args, **kwargs ):
+        """
+        Call func at the clock time when, returning a ScheduledCall that can be
+        cancelled.
+        """
+        call = ScheduledCall( self, when, func, args, kwargs )
+        heapq.heappush( self.heap, ( when, next( self.counter ), call ) )
+
+        if self.heap[0][2] is call:
+            self.reschedule()
+
+        return call
+
+    def callLater( self, delay, func, *args, **kwargs ):
+        if delay < 0:
+            raise TimerSchedulerException( 'negative delay' )
+
+        return self.callAt( self.seconds() + delay, func, *args, **kwargs )
+
+    def cancel( self, call ):
+        if not call.active():
+            return
+
+        call.cancelled = True
+        if not call.in_heap:
+            return
+
+        self.cancelled += 1
+
+        if self.cancelled > self.compact_minimum and self.cancelled * 2 > len( self.heap ):
+            self.heap = [ entry for entry in self.heap if not entry[2].cancelled ]
+            heapq.heapify( self.heap )
+            self.cancelled = 0
+
+        if self.heap and self.heap[0][2] is call:
+            self.reschedule()
+
+    def reschedule( self ):
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop( self.heap )[2].in_heap = False
+            self.cancelled -= 1
+
+        if not self.heap:
+            if self.delayed_call and self.delayed_call.active():
+                self.delayed_call.cancel()
+            self.delayed_call = None
+            return
+
+        delay = max( 0, self.heap[0][0] - self.seconds() )
+
+        if self.delayed_call and self.delayed_call.active():
+            self.delayed_call.reset( delay )
+        else:
+            self.delayed_call = self.clock.callLater( delay, self.runDue )
+
+    def runDue( self ):
+        self.delayed_call = None
+        now = self.seconds()
+
+        # pop everything due first, so calls scheduled by the ones we run wait
+        # for the next round
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            call = heapq.heappop( self.heap )[2]
+            call.in_heap = False
+
+            if call.cancelled:
+                self.cancelled -= 1
+                continue
+
+            due.append( call )
+
+        for call in due:
+            if call.cancelled:
+                continue
+
+            call.called = True
+            try:
+                call.func( *call.args, **call.kwargs )
+            except:
+                log.err()
+
+        log.msg( 'TimerScheduler: ran %d calls, %d pending' % ( len( due ), len( self ) ), level = logging.DEBUG )
+        self.reschedule()
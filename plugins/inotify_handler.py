@@ -1,127 +1,330 @@
-
-import pyinotify, logging
+import pyinotify, logging, os, bisect
 from twisted.python import log
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
+from twisted.internet.interfaces import IReadDescriptor
+from zope.interface import implementer
 
-class INotifyHandler( object ):
+# watched on every directory covered by a recursive trigger, so directories
+# created, moved in or moved out below it are followed
+RECURSIVE_MASK = pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM
 
-    def __init__( self, triggers ):
+@implementer( IReadDescriptor )
+class INotifyHandler( object ):
+    """
+    Watches the paths of filesystem triggers. The inotify descriptor is added
+    to the reactor as a reader, so events are read and dispatched as soon as
+    the kernel delivers them instead of being polled for.
+
+    Recursive triggers get a watch on every directory below their path,
+    including directories created later; the directories on disk are walked
+    in a thread so a large tree does not hold up the reactor. The watched
+    paths are kept sorted, so the watches below a directory are a slice of
+    them rather than a scan of every watch.
+
+    Each watched path has a dispatch table mapping an event bit to the
+    triggers subscribed to it, rebuilt whenever the watch is, so an event
+    goes straight to its triggers.
+    """
+
+    def __init__( self, triggers = () ):
         self.wm = pyinotify.WatchManager()
-        self.event_handler = FilesystemEventHandler()
-        self.notifier = pyinotify.Notifier( self.wm, self.event_handler, timeout = 10 )
-        self.paths = {}
-        self.wds = []
-        self.check_interval = 10
+        self.event_handler = FilesystemEventHandler( handler = self )
+        self.notifier = pyinotify.Notifier( self.wm, self.event_handler )
+        self.triggers = PathTrie()
+        self.watches = {}
+        self.watched_paths = []
+        self.dispatch_tables = {}
 
         for trigger in triggers:
-            log.msg( trigger.name, level = logging.DEBUG )
-            path = trigger.path
+            self.addTrigger( trigger )
+
+        reactor.addReader( self )
+
+    def addTrigger( self, trigger ):
+        log.msg( trigger.name, level = logging.DEBUG )
+        self.triggers.add( trigger.path, trigger )
+        self.updateWatches( trigger.path, trigger.recursive )
+
+    def removeTrigger( self, trigger ):
+        self.triggers.remove( trigger.path, trigger )
+        self.updateWatches( trigger.path, trigger.recursive )
+
+    def updateWatches( self, path, recursive = False ):
+        """
+        Update the watch on path and, when recursive, the watches on every
+        directory below it: those already watched right away, those on disk
+        once walkDirectories has found them. Symlinked directories below path
+        are not followed; path itself is watched even when it is a symlink.
+        """
+        self.updateWatch( path )
+
+        if recursive:
+            for watched in self.getWatchedBelow( path ):
+                self.updateWatch( watched )
+
+            self.walkDirectories( path )
+
+    def walkDirectories( self, path ):
+        """
+        List the directories below path in a thread and update their watches
+        once back in the reactor. updateWatch works from the triggers as they
+        are by then, so changes made while the walk ran are not undone.
+        """
+        d = threads.deferToThread( listDirectories, path )
+        d.addCallback( self.updateWatchList )
+        d.addErrback( log.err )
+        return d
+
+    def updateWatchList( self, paths ):
+        for path in paths:
+            self.updateWatch( path )
+
+    def getWatchedBelow( self, path ):
+        """
+        Return the watched paths below path, not path itself.
+        """
+        prefix = os.path.join( path, '' )
+
+        # every path starting with prefix sorts between prefix and prefix with
+        # its trailing separator bumped to the next character
+        start = bisect.bisect_left( self.watched_paths, prefix )
+        end = bisect.bisect_left( self.watched_paths, prefix[:-1] + chr( ord( os.sep ) + 1 ) )
+
+        return self.watched_paths[ start:end ]
+
+    def updateWatch( self, path ):
+        """
+        Rebuild the dispatch table of path from the triggers covering it and
+        add, narrow, widen or remove the watch on path so that its mask holds
+        just the events they need.
+        """
+        table = {}
+        mask = 0
+
+        for trigger in self.triggers.getTriggers( path ):
+            if trigger.recursive:
+                mask |= RECURSIVE_MASK
+
+            for event_type in trigger.event_types:
+                if not event_type in table:
+                    table[ event_type ] = []
+
+                table[ event_type ].append( trigger )
+                mask |= event_type
+
+        wd = self.watches.get( path )
+
+        if not mask:
+            if wd is not None:
+                self.wm.rm_watch( wd )
+                self.dropWatch( path )
+            return
 
-            if not path in self.paths:
-                self.paths[ path ] = []
+        if wd is None:
+            wd = self.wm.add_watch( path, mask ).get( path, -1 )
+
+            if wd < 0:
+                log.err( 'Unable to watch %s' % path )
+                return
+
+            self.watches[ path ] = wd
+            bisect.insort( self.watched_paths, path )
+        else:
+            self.wm.update_watch( wd, mask )
+
+        self.dispatch_tables[ path ] = table
+
+    def dropWatch( self, path ):
+        del self.watches[ path ]
+        del self.dispatch_tables[ path ]
+        del self.watched_paths[ bisect.bisect_left( self.watched_paths, path ) ]
+
+    def addDirectory( self, path ):
+        """
+        Watch a directory that appeared below a watched one, if a recursive
+        trigger covers it and it is not a symlink, and the directories below
+        it. Nothing below a new directory is watched yet, so only its subtree
+        on disk is walked.
+        """
+        if os.path.islink( path ):
+            return
 
-            for et in trigger.event_types:
-                if not et in self.paths[ path ]:
-                    self.paths[ path ].append( et )
+        for trigger in self.triggers.getTriggers( path ):
+            if trigger.recursive:
+                self.updateWatch( path )
+                self.walkDirectories( path )
+                return
+
+    def removeDirectory( self, path ):
+        """
+        Drop the watches on a directory moved away from below a watched one
+        and on everything below it; their paths are no longer right.
+        """
+        if not path in self.watches:
+            return
 
-            self.event_handler.registerTrigger( trigger )
+        for watched in [ path ] + self.getWatchedBelow( path ):
+            self.wm.rm_watch( self.watches[ watched ] )
+            self.dropWatch( watched )
+
+    def watchRemoved( self, path, wd ):
+        if self.watches.get( path ) == wd:
+            self.dropWatch( path )
+
+    def rescan( self ):
+        """
+        Events were lost: bring the watches up to date and let every trigger
+        know something may have changed below its path.
+        """
+        log.msg( 'INotifyHandler: event queue overflowed, rescanning', level = logging.DEBUG )
+
+        triggers = list( self.triggers )
+
+        for trigger in triggers:
+            self.updateWatches( trigger.path, trigger.recursive )
 
-        for path in self.paths:
-            mask = 0
-            for et in self.paths[ path ]:
-                mask |= et
+        for trigger in triggers:
+            trigger.notify( trigger.path )
 
-            wd = self.wm.add_watch( path, mask )
-            self.wds.append( wd )
+    def fileno( self ):
+        return self.wm.get_fd()
 
-        reactor.callLater( self.check_interval, self.checkForEvents )
+    def logPrefix( self ):
+        return 'INotifyHandler'
 
-    def checkForEvents( self ):
-        log.msg( 'checkFileSystem', level = logging.DEBUG )
-        assert self.notifier._timeout is not None, 'Filesystem notifier must be constructed with a short timeout.'
+    def doRead( self ):
+        self.notifier.read_events()
         self.notifier.process_events()
-        while self.notifier.check_events():
-            self.notifier.read_events()
-            self.notifier.process_events()
 
-        reactor.callLater( self.check_interval, self.checkForEvents )
+    def connectionLost( self, reason ):
+        log.msg( 'INotifyHandler: descriptor lost: %s' % reason.getErrorMessage(), level = logging.DEBUG )
 
-class FilesystemEventHandler( pyinotify.ProcessEvent ):
+class PathTrieNode( object ):
+    __slots__ = ( 'children', 'triggers' )
 
-    def my_init( self ):
-        log.msg( 'Filesystem my_init', level = logging.DEBUG )
-        self.my_paths = {}
+    def __init__( self ):
+        self.children = {}
+        self.triggers = []
 
-    def process_IN_CREATE( self, event ):
-        log.msg( 'Filesystem Event: Create', level = logging.DEBUG )
-        log.msg( str( event ), level = logging.DEBUG )
+class PathTrie( object ):
+    """
+    Filesystem triggers keyed by the components of their path, so the
+    triggers covering a directory, the ones on the directory itself and the
+    recursive ones on its ancestors, are found in O(depth) of the directory
+    rather than by testing every trigger.
+    """
 
-        if not event.path in self.my_paths:
-            return
+    def __init__( self ):
+        self.root = PathTrieNode()
 
-        for trigger in self.my_paths[ event.path ]:
-            log.msg( 'Testing trigger %s' % str( trigger ), level = logging.DEBUG )
-            if not trigger.mask & pyinotify.IN_CREATE:
-                log.msg( 'Mask does not match', level = logging.DEBUG )
-                continue
+    def __iter__( self ):
+        nodes = [ self.root ]
 
-            if not trigger.path == event.path:
-                log.msg( 'Path does not match', level = logging.DEBUG )
-                continue
+        while nodes:
+            node = nodes.pop()
+            nodes.extend( node.children.values() )
 
-            trigger.run()
+            for trigger in node.triggers:
+                yield trigger
 
-    def process_IN_DELETE( self, event ):
-        log.msg( 'Filesystem Event: Delete', level = logging.DEBUG )
-        log.msg( str( event ), level = logging.DEBUG )
+    def add( self, path, trigger ):
+        node = self.root
 
-        if not event.path in self.my_paths:
-            return
+        for component in splitPath( path ):
+            if not component in node.children:
+                node.children[ component ] = PathTrieNode()
 
-        for trigger in self.my_paths[ event.path ]:
-            log.msg( 'Testing trigger %s' % str( trigger ), level = logging.DEBUG )
-            if not trigger.mask & pyinotify.IN_DELETE:
-                log.msg( 'Mask does not match', level = logging.DEBUG )
-                continue
+            node = node.children[ component ]
 
-            if not trigger.path == event.path:
-                log.msg( 'Path does not match', level = logging.DEBUG )
-                continue
+        node.triggers.append( trigger )
 
-            trigger.run()
+    def remove( self, path, trigger ):
+        components = splitPath( path )
+        nodes = [ self.root ]
 
-    def process_IN_MODIFY( self, event ):
-        log.msg( 'Filesystem Event: Modify', level = logging.DEBUG )
-        log.msg( str( event ), level = logging.DEBUG )
+        for component in components:
+            if not component in nodes[-1].children:
+                return
+
+            nodes.append( nodes[-1].children[ component ] )
 
-        if not event.path in self.my_paths:
+        if not trigger in nodes[-1].triggers:
             return
 
-        for trigger in self.my_paths[ event.path ]:
-            log.msg( 'Testing trigger %s' % str( trigger ), level = logging.DEBUG )
-            if not trigger.mask & pyinotify.IN_MODIFY:
-                log.msg( 'Mask does not match', level = logging.DEBUG )
-                continue
+        nodes[-1].triggers.remove( trigger )
 
-            if not trigger.path == event.path:
-                log.msg( 'Path does not match', level = logging.DEBUG )
-                continue
+        # drop the nodes left without triggers or children
+        for depth in range( len( components ), 0, -1 ):
+            if nodes[ depth ].triggers or nodes[ depth ].children:
+                break
+
+            del nodes[ depth - 1 ].children[ components[ depth - 1 ] ]
+
+    def getTriggers( self, path ):
+        """
+        Return the triggers covering path.
+        """
+        triggers = []
+        node = self.root
 
-            trigger.run()
+        for component in splitPath( path ):
+            triggers.extend( trigger for trigger in node.triggers if trigger.recursive )
+            node = node.children.get( component )
 
-    def registerTrigger( self, trigger ):
-        log.msg( 'Registering trigger: %s' % trigger.name, level = logging.DEBUG )
-        path = trigger.path
+            if node is None:
+                return triggers
 
-        if not path in self.my_paths:
-            self.my_paths[ path ] = []
+        triggers.extend( node.triggers )
+        return triggers
 
-        self.my_paths[ path ].append( trigger )
+def listDirectories( path ):
+    """
+    Return the directories below path, without following symlinks.
+    """
+    directories = []
 
-    def unregisterTrigger( self, trigger ):
-        path = trigger.path
+    for directory, subdirectories, files in os.walk( path ):
+        for subdirectory in subdirectories:
+            subdirectory = os.path.join( directory, subdirectory )
+
+            if not os.path.islink( subdirectory ):
+                directories.append( subdirectory )
+
+    return directories
+
+def splitPath( path ):
+    return [ component for component in os.path.normpath( path ).split( os.sep ) if component ]
+
+class FilesystemEventHandler( pyinotify.ProcessEvent ):
 
-        if not path in self.my_paths or not trigger in self.my_paths[ path ]:
+    def my_init( self, handler = None ):
+        log.msg( 'Filesystem my_init', level = logging.DEBUG )
+        self.handler = handler
+
+    def process_default( self, event ):
+        log.msg( str( event ), level = logging.DEBUG )
+        event_type = event.mask & ~pyinotify.IN_ISDIR
+
+        if event.dir:
+            if event_type & ( pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO ):
+                self.handler.addDirectory( event.pathname )
+            elif event_type & pyinotify.IN_MOVED_FROM:
+                self.handler.removeDirectory( event.pathname )
+
+        table = self.handler.dispatch_tables.get( event.path )
+
+        if not table or not event_type in table:
             return
 
-        del self.my_paths[ path ][ trigger ]
+        for trigger in table[ event_type ]:
+            if event.name and not trigger.matchesName( event.name ):
+                log.msg( 'Name does not match %s' % trigger.name, level = logging.DEBUG )
+                continue
+
+            trigger.notify( event.pathname )
+
+    def process_IN_IGNORED( self, event ):
+        self.handler.watchRemoved( event.path, event.wd )
+
+    def process_IN_Q_OVERFLOW( self, event ):
+        self.handler.rescan()
@@ -1,12 +1,294 @@
 from twisted.words.protocols.jabber import jid
+from twisted.internet import reactor
 from twisted.python import log
 from wokkel import muc, data_form
-import logging, ConfigParser
+import collections, logging, ConfigParser
 
 from common import CommonClientManager
 
 MUC_CONFIG_FILE_DEFAULT = 'muc.ini'
 
+class MucJoinSchedulerException( Exception ):
+    pass
+
+class MucJoinScheduler( object ):
+    """
+    Joins the rooms it is given with join( room_jid ), which returns a
+    deferred, at most max_joining at a time and rooms of a higher priority
+    first.
+
+    A join failing with a permanent error, or max_attempts times, gives the
+    room up; other failures are retried after retry_delay seconds, doubling
+    with each attempt up to retry_max_delay.
+
+    Rooms are remembered until removed, so connected() rejoins all of them
+    after a reconnect; getStats() reports how long the last full rejoin took.
+    """
+    priorities = [ 'high', 'normal', 'low' ]
+    permanent_conditions = [ 'forbidden', 'not-authorized', 'registration-required', 'not-allowed' ]
+    counters = [ 'joins', 'failures', 'given_up' ]
+
+    def __init__( self, join, max_joining = 4, retry_delay = 5, retry_max_delay = 300, max_attempts = 10, clock = reactor ):
+        self.join = join
+        self.max_joining = max_joining
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self.max_attempts = max_attempts
+        self.clock = clock
+
+        # room jid -> priority of every room we want to be in
+        self.rooms = {}
+        self.joined = set()
+        # room jid -> attempts so far, per priority
+        self.levels = [ collections.OrderedDict() for priority in self.priorities ]
+        self.joining = set()
+        self.retries = {}
+        self.is_connected = False
+
+        # joins answered after a disconnect belong to the old connection
+        self.generation = 0
+
+        self.rejoin_started = None
+        self.rejoin_rooms = set()
+        self.rejoin_count = 0
+        self.rejoin_duration = None
+
+        self.joins = 0
+        self.failures = 0
+        self.given_up = 0
+
+    def add( self, room_jid, priority = 'normal' ):
+        """
+        Remember room_jid, a bare room JID, and join it unless it is joined or
+        about to be.
+        """
+        if not priority in self.priorities:
+            raise MucJoinSchedulerException( 'invalid priority %s' % priority )
+
+        self.rooms[ room_jid ] = priority
+
+        if room_jid in self.joined or room_jid in self.joining or room_jid in self.retries or self.isQueued( room_jid ):
+            return
+
+        self.queue( room_jid, 0 )
+        self.pump()
+
+    def remember( self, room_jid, priority = 'normal' ):
+        """
+        Remember room_jid as joined by other means.
+        """
+        if not priority in self.priorities:
+            raise MucJoinSchedulerException( 'invalid priority %s' % priority )
+
+        self.rooms[ room_jid ] = priority
+        self.joined.add( room_jid )
+
+    def remove( self, room_jid ):
+        """
+        Forget room_jid, after leaving it or being kicked from it.
+        """
+        self.rooms.pop( room_jid, None )
+        self.joined.discard( room_jid )
+
+        for level in self.levels:
+            level.pop( room_jid, None )
+
+        if room_jid in self.retries:
+            retry = self.retries.pop( room_jid )
+            if retry.active():
+                retry.cancel()
+
+        self.settled( room_jid )
+
+    def left( self, room_jid ):
+        """
+        Note that we are out of room_jid without having left it, as when the
+        room was destroyed; it stays remembered and is joined again when it is
+        added again or on the next connect.
+        """
+        self.joined.discard( room_jid )
+
+    def isQueued( self, room_jid ):
+        for level in self.levels:
+            if room_jid in level:
+                return True
+
+        return False
+
+    def queue( self, room_jid, attempts ):
+        self.levels[ self.priorities.index( self.rooms[ room_jid ] ) ][ room_jid ] = attempts
+
+    def connected( self ):
+        """
+        Join every remembered room.
+        """
+        self.is_connected = True
+
+        for room_jid in self.rooms:
+            if not room_jid in self.joined and not room_jid in self.joining and not room_jid in self.retries and not self.isQueued( room_jid ):
+                self.queue( room_jid, 0 )
+
+        self.rejoin_rooms = set( self.rooms ) - self.joined
+        self.rejoin_count = len( self.rejoin_rooms )
+        self.rejoin_started = self.clock.seconds()
+
+        log.msg( 'MucJoinScheduler: joining %d rooms' % self.rejoin_count, level = logging.DEBUG )
+        self.pump()
+        self.checkRejoin()
+
+    def disconnected( self ):
+        """
+        Stop joining; the rooms are left but still remembered.
+        """
+        self.is_connected = False
+        self.generation += 1
+
+        for level in self.levels:
+            level.clear()
+
+        for retry in self.retries.values():
+            if retry.active():
+                retry.cancel()
+
+        self.retries.clear()
+        self.joining.clear()
+        self.joined.clear()
+        self.rejoin_started = None
+
+    def pump( self ):
+        while self.is_connected and len( self.joining ) < self.max_joining:
+            for level in self.levels:
+                if level:
+                    room_jid, attempts = level.popitem( last = False )
+                    break
+            else:
+                return
+
+            self.start( room_jid, attempts )
+
+    def start( self, room_jid, attempts ):
+        log.msg( 'MucJoinScheduler: joining %s' % room_jid.full(), level = logging.DEBUG )
+        self.joining.add( room_jid )
+
+        self.join( room_jid ).addCallbacks( self.joinSucceeded, self.joinFailed,
+                                            callbackArgs = ( room_jid, self.generation ),
+                                            errbackArgs = ( room_jid, attempts, self.generation ) )
+
+    def joinSucceeded( self, response, room_jid, generation ):
+        if generation != self.generation:
+            return
+
+        self.joining.discard( room_jid )
+        self.joins += 1
+
+        if room_jid in self.rooms:
+            self.joined.add( room_jid )
+
+        self.settled( room_jid )
+        self.pump()
+
+    def joinFailed( self, reason, room_jid, attempts, generation ):
+        if generation != self.generation:
+            return
+
+        self.joining.discard( room_jid )
+        self.failures += 1
+        attempts += 1
+
+        condition = getattr( reason.value, 'condition', None )
+        log.msg( 'MucJoinScheduler: joining %s failed: %s' % ( room_jid.full(), condition or reason.getErrorMessage() ), level = logging.DEBUG )
+
+        if not room_jid in self.rooms:
+            pass
+        elif condition in self.permanent_conditions or attempts >= self.max_attempts:
+            log.msg( 'MucJoinScheduler: giving up on %s' % room_jid.full() )
+            self.given_up += 1
+            self.rooms.pop( room_jid, None )
+            self.settled( room_jid )
+        else:
+            delay = min( self.retry_delay * 2 ** ( attempts - 1 ), self.retry_max_delay )
+            self.retries[ room_jid ] = self.clock.callLater( delay, self.retry, room_jid, attempts )
+
+        self.pump()
+
+    def retry( self, room_jid, attempts ):
+        del self.retries[ room_jid ]
+
+        if self.is_connected and room_jid in self.rooms:
+            self.queue( room_jid, attempts )
+            self.pump()
+
+    def settled( self, room_jid ):
+        """
+        Count room_jid as done for the rejoin in progress.
+        """
+        self.rejoin_rooms.discard( room_jid )
+        self.checkRejoin()
+
+    def checkRejoin( self ):
+        if self.rejoin_started is None or self.rejoin_rooms:
+            return
+
+        self.rejoin_duration = self.clock.seconds() - self.rejoin_started
+        self.rejoin_started = None
+
+        log.msg( 'MucJoinScheduler: joined %d rooms in %.2f seconds' % ( self.rejoin_count, self.rejoin_duration ) )
+
+    def getStats( self ):
+        stats = { 'rooms': len( self.rooms ),
+                  'joined': len( self.joined ),
+                  'joining': len( self.joining ),
+                  'queued': sum( len( level ) for level in self.levels ),
+                  'retrying': len( self.retries ),
+                  'rejoin_rooms': self.rejoin_count,
+                  'rejoin_pending': len( self.rejoin_rooms ),
+                  'rejoin_duration': self.rejoin_duration,
+                }
+
+        for counter in self.counters:
+            stats[ counter ] = getattr( self, counter )
+
+        return stats
+
+class RoomOccupant( object ):
+    """
+    An occupant of a room, kept in place of wokkel's User.
+    """
+    __slots__ = ( 'nick', 'entity', 'affiliation', 'role' )
+
+    def __init__( self, nick, entity, affiliation, role ):
+        self.nick = nick
+        self.entity = entity
+        self.affiliation = affiliation
+        self.role = role
+
+class RoomState( object ):
+    """
+    A room we are joining or in: our nick in it, whether the join completed
+    and, unless occupants are not tracked for the room, its occupants by nick.
+    """
+    __slots__ = ( 'room_jid', 'nick', 'joined', 'occupants' )
+
+    def __init__( self, room_jid, nick, track_occupants = True ):
+        self.room_jid = room_jid
+        self.nick = nick
+        self.joined = False
+
+        if track_occupants:
+            self.occupants = {}
+        else:
+            self.occupants = None
+
+def getRoomKey( room_jid ):
+    """
+    Return the bare room JID string of room_jid, a JID or a string, which
+    may carry a nick.
+    """
+    if isinstance( room_jid, basestring ):
+        room_jid = jid.JID( room_jid )
+
+    return room_jid.userhost()
+
 class CommonMucHandler( muc.MUCClient ):
     history_options = muc.HistoryOptions( maxStanzas = 0 )
 
@@ -28,6 +310,19 @@ class CommonMucHandler( muc.MUCClient ):
         else:
             self.muc_domain = 'conference.' + self.my_client.domain
 
+        general = self.config.get( 'general', {} )
+
+        # bare room JID string -> RoomState of the rooms we are joining or in
+        self.room_states = {}
+        self.track_occupants = general.get( 'track_occupants', 'True' ) == 'True'
+        self.untracked_rooms = self.config.get( 'untracked_rooms', {} )
+
+        self.join_scheduler = MucJoinScheduler( self.joinRoom,
+                                                int( general.get( 'join_max_concurrent', 4 ) ),
+                                                float( general.get( 'join_retry_delay', 5 ) ),
+                                                float( general.get( 'join_retry_max_delay', 300 ) ),
+                                                int( general.get( 'join_max_attempts', 10 ) ) )
+
     def connectionInitialized(self):
         super( CommonMucHandler, self ).connectionInitialized()
 
@@ -41,14 +336,166 @@ class CommonMucHandler( muc.MUCClient ):
             log.msg( self.config[ 'default_rooms' ], level = logging.DEBUG )
             for room, value in self.config[ 'default_rooms' ].items():
                 log.msg( 'Default muc room: %s' % room, level = logging.DEBUG )
+
+                # True joins at normal priority, a priority name at that one
                 if value == 'True':
-                    log.msg( "Joining default room: %s %s" % ( '@'.join( [ room, self.muc_domain ] ), self.my_client.jid.user ) )
-                    self.join( jid.JID( '@'.join( [ room, self.muc_domain ] ) ), self.my_client.jid.user, historyOptions = muc.HistoryOptions( maxStanzas = 0 ) ).addErrback( log.err )
+                    value = 'normal'
+
+                if value in MucJoinScheduler.priorities:
+                    self.join_scheduler.add( jid.JID( '@'.join( [ room, self.muc_domain ] ) ), value )
+
+        # rejoins the rooms of the previous connection too
+        self.join_scheduler.connected()
 
     def connectionLost(self, reason):
         log.msg( 'connectionLost', level = logging.DEBUG )
-        for room in self._rooms.values():
-            self._removeRoom( room.entity_id )
+        self.join_scheduler.disconnected()
+
+        for room_jid in self._rooms.keys():
+            self._removeRoom( room_jid )
+
+        super( CommonMucHandler, self ).connectionLost( reason )
+
+    def joinRoom(self, room_jid):
+        log.msg( "Joining room: %s %s" % ( room_jid.full(), self.my_client.jid.user ) )
+        return self.join( room_jid, self.my_client.jid.user, historyOptions = self.history_options )
+
+    def join(self, roomJID, nick, historyOptions = None, password = None):
+        room_key = getRoomKey( roomJID )
+        self.room_states[ room_key ] = RoomState( room_key, nick, self.tracksOccupants( roomJID ) )
+
+        def joined( room ):
+            if room_key in self.room_states:
+                self.room_states[ room_key ].joined = True
+
+            return room
+
+        # a failed join removes the room, and its state, in _removeRoom
+        return super( CommonMucHandler, self ).join( roomJID, nick, historyOptions, password ).addCallback( joined )
+
+    def nick(self, roomJID, nick):
+
+        def nickChanged( room ):
+            room_state = self.room_states.get( getRoomKey( roomJID ) )
+
+            if room_state is not None:
+                room_state.nick = nick
+
+            return room
+
+        return super( CommonMucHandler, self ).nick( roomJID, nick ).addCallback( nickChanged )
+
+    def _removeRoom(self, roomJID):
+        self.room_states.pop( getRoomKey( roomJID ), None )
+        super( CommonMucHandler, self )._removeRoom( roomJID )
+
+    def tracksOccupants(self, room_jid):
+        """
+        Whether occupants of room_jid are kept; rooms we only post to can be
+        listed, by name or bare JID, in untracked_rooms.
+        """
+        return self.track_occupants and not room_jid.user in self.untracked_rooms and not room_jid.userhost() in self.untracked_rooms
+
+    def getRoomState(self, room_jid):
+        return self.room_states.get( getRoomKey( room_jid ) )
+
+    def isInRoom(self, room_jid):
+        """
+        Whether we have joined room_jid, a JID or a string.
+        """
+        room_state = self.room_states.get( getRoomKey( room_jid ) )
+        return room_state is not None and room_state.joined
+
+    def isPresent(self, room_jid, nick):
+        """
+        Whether nick is in room_jid; always False for rooms whose occupants are
+        not tracked.
+        """
+        room_state = self.room_states.get( getRoomKey( room_jid ) )
+        return room_state is not None and room_state.occupants is not None and nick in room_state.occupants
+
+    def getOccupant(self, room_jid, nick):
+        room_state = self.room_states.get( getRoomKey( room_jid ) )
+
+        if room_state is None or room_state.occupants is None:
+            return None
+
+        return room_state.occupants.get( nick )
+
+    def getOccupants(self, room_jid):
+        """
+        Return the RoomOccupants of room_jid, or None when they are not
+        tracked or we are not in it.
+        """
+        room_state = self.room_states.get( getRoomKey( room_jid ) )
+
+        if room_state is None or room_state.occupants is None:
+            return None
+
+        return room_state.occupants.values()
+
+    def _getRoomUser(self, stanza):
+        """
+        Look up the room and occupant of the sender of stanza in the room
+        states instead of wokkel's rosters.
+        """
+        occupant_jid = stanza.sender
+
+        if not occupant_jid:
+            return None, None
+
+        room = self._getRoom( occupant_jid.userhostJID() )
+        room_state = self.room_states.get( occupant_jid.userhost() )
+
+        if room is None or room_state is None or room_state.occupants is None:
+            return room, None
+
+        return room, room_state.occupants.get( occupant_jid.resource )
+
+    def availableReceived(self, presence):
+        room, occupant = self._getRoomUser( presence )
+
+        if room is None:
+            return
+
+        room_state = self.room_states.get( presence.sender.userhost() )
+
+        if room_state is None or room_state.occupants is None:
+            return
+
+        if occupant is None:
+            nick = presence.sender.resource
+            occupant = RoomOccupant( nick, presence.entity, presence.affiliation, presence.role )
+            room_state.occupants[ nick ] = occupant
+            self.userJoinedRoom( room, occupant )
+        else:
+            occupant.affiliation = presence.affiliation
+            occupant.role = presence.role
+            self.userUpdatedStatus( room, occupant, presence.show, presence.status )
+
+    def unavailableReceived(self, presence):
+        room, occupant = self._getRoomUser( presence )
+
+        if room is None:
+            return
+
+        room_state = self.room_states.get( presence.sender.userhost() )
+
+        # we are out of the room, unless we only changed our nick
+        if room_state is not None and presence.sender.resource == room_state.nick and not muc.STATUS_CODE.NEW_NICK in presence.mucStatuses:
+            self.join_scheduler.left( room.roomJID )
+            self._removeRoom( room.roomJID )
+            return
+
+        if occupant is None:
+            return
+
+        del room_state.occupants[ occupant.nick ]
+        self.userLeftRoom( room, occupant )
+
+    def leaveRoom(self, room_jid):
+        self.join_scheduler.remove( room_jid )
+        return self.leave( room_jid )
 
     def createRoom(self, room):
 
@@ -87,7 +534,11 @@ class CommonMucHandler( muc.MUCClient ):
 
             return self.getConfigureForm( room.entity_id.userhost() ).addCallback( configureRoom ).addErrback( log.err )
 
-        return self.join( self.muc_domain, room, self.my_client.jid.user ).addCallback( roomJoined ).addErrback( log.err )
+        def remember( room ):
+            self.join_scheduler.remember( room.roomJID )
+            return room
+
+        return self.join( jid.JID( '@'.join( [ room, self.muc_domain ] ) ), self.my_client.jid.user ).addCallback( remember ).addCallback( roomJoined ).addErrback( log.err )
 
     def receivedGroupChat(self, room, user, body):
         log.msg( 'received group chat', level = logging.DEBUG )
@@ -100,18 +551,17 @@ class CommonMucHandler( muc.MUCClient ):
     def receivedRoomInviteMessage(self, message):
         log.msg( 'receivedRoomInviteMessage', level = logging.DEBUG )
 
-        def response_roomJoined( room ):
-            log.msg( 'response_roomJoined', level = logging.DEBUG )
+        room_jid = jid.JID( message['from'] ).userhostJID()
 
-        if message['from'].lower() in self._rooms:
+        if self.isInRoom( room_jid ):
             return
 
-        room, server = message['from'].split( '@' )
-        self.join( server, room, self.my_client.jid.user, self.history_options ).addCallback( response_roomJoined ).addErrback( log.err )
+        self.join_scheduler.add( room_jid )
 
     def receivedRoomKickMessage(self, message):
         log.msg( 'receivedRoomKickMessage', level = logging.DEBUG )
         room_jid = jid.JID( message['from'].lower() ).userhostJID()
+        self.join_scheduler.remove( room_jid )
         self._removeRoom( room_jid )
 
     def roomJoined( self, message ):
@@ -1,32 +1,44 @@
 
 from twisted.words.xish import domish
 from twisted.words.protocols.jabber import xmlstream
-from twisted.python import log
+from twisted.python import log, threadpool
+from twisted.internet import reactor, defer, threads
 from wokkel.subprotocols import XMPPHandler
-import xmlrpclib, xml.dom.minidom, logging
+import xmlrpclib, datetime, base64, collections, logging
 
 from common import CommonClientManager
 
 NS_RPC = 'jabber:iq:rpc'
 
-def removeWhitespaceNodes(dom):
-    """
-    This method is called recursively for each element within the submitted dom
-    and is used to remove empty whitespace elements
-    """
-    for child in list( dom.childNodes ):
-        if child.nodeType == child.TEXT_NODE and child.data.strip() == '':
-            dom.removeChild(child)
-        else:
-            removeWhitespaceNodes(child)
+# the range of XML-RPC ints
+MAXINT = 2**31 - 1
+MININT = -2**31
+
+# fault codes of the XML-RPC interoperability spec
+FAULT_METHOD_NOT_FOUND = 1
+FAULT_INVALID_REQUEST = -32600
+FAULT_INVALID_PARAMS = -32602
+FAULT_INTERNAL_ERROR = -32603
+FAULT_TIMEOUT = -32000
+FAULT_BUSY = -32001
 
 class RPCProtocolHandler( XMPPHandler ):
     subscribed_methods = {}
 
+    # limits on the params of incoming calls and of results
+    max_depth = 32
+    max_values = 10000
+    max_size = 1048576
+
+    # unanswered calls allowed per peer and seconds calls wait for an answer
+    max_in_flight = 8
+    call_timeout = 60
+
     def __init__( self, client ):
         super( RPCProtocolHandler, self ).__init__()
 
         self.my_client = client
+        self.peers = {}
 
     def connectionInitialized(self):
         RPC_SET = "/iq[@type='set']/query[@xmlns='%s']" % NS_RPC
@@ -35,59 +47,468 @@ class RPCProtocolHandler( XMPPHandler ):
     def onMethodCall(self, iq):
         log.msg( 'onMethodCall', level = logging.DEBUG )
 
-        method_name = str( iq.query.methodName )
+        # XEP-0009 wraps the call in methodCall, our peers put it right in query
+        method_call = iq.query.methodCall or iq.query
 
-        if not method_name in self.subscribed_methods:
-            # send error response
-            err_iq = FaultResponse( self.xmlstream, 1, 'method not implemented' )
-            err_iq['id'] = iq.getAttribute('id')
-            err_iq['to'] = iq.getAttribute('from')
-            err_iq.send()
+        if not method_call.methodName:
+            self.sendFault( iq, FAULT_INVALID_REQUEST, 'missing methodName' )
+            return
+
+        method_name = getText( method_call.methodName ).strip()
+
+        if not method_name in self.subscribed_methods and method_name != 'system.multicall':
+            self.sendFault( iq, FAULT_METHOD_NOT_FOUND, 'method not implemented' )
             return
 
         log.msg( 'method found', level = logging.DEBUG )
-        target_method = self.subscribed_methods[ method_name ]
-        converted_data = xmlrpclib.loads( iq.query.params.toXml() )[0]
+
+        try:
+            converted_data = RPCDecoder( self.max_depth, self.max_values, self.max_size ).decodeParams( method_call.params )
+        except RPCExceptionInvalid, e:
+            log.msg( 'invalid params for %s: %s' % ( method_name, e ), level = logging.DEBUG )
+            self.sendFault( iq, FAULT_INVALID_PARAMS, 'invalid params: %s' % e )
+            return
 
         log.msg( 'converted_data', level = logging.DEBUG )
-        log.msg( iq.query.params.toXml(), level = logging.DEBUG )
         log.msg( converted_data, level = logging.DEBUG )
-        method_result = target_method( iq, *converted_data )
+
+        if not method_name in self.subscribed_methods:
+            d = self.multicall( iq, converted_data )
+        elif self.subscribed_methods[ method_name ].cache is None:
+            d = self.subscribed_methods[ method_name ].call( iq, converted_data )
+        else:
+            rpc_method = self.subscribed_methods[ method_name ]
+            cache_key = cacheKey( converted_data )
+            cached_response = rpc_method.cache.get( cache_key )
+
+            if cached_response is not None:
+                log.msg( 'cached response for %s' % method_name, level = logging.DEBUG )
+                self.sendResult( cached_response, iq )
+                return
+
+            d = rpc_method.call( iq, converted_data ).addCallback( self.cacheResult, rpc_method.cache, cache_key )
+
+        d.addCallback( self.sendResult, iq )
+
+    def multicall(self, iq, params):
+        """
+        Serve system.multicall: make each call of the array of method name and
+        params structs and answer with the array of their results, each in an
+        array of its own, or fault structs.
+        """
+        if len( params ) != 1 or not isinstance( params[0], list ):
+            return defer.succeed( RPCFault( FAULT_INVALID_PARAMS, 'system.multicall takes an array of calls' ) )
+
+        calls = []
+        for call in params[0]:
+            if not isinstance( call, dict ) or not isinstance( call.get( 'methodName' ), basestring ) or not isinstance( call.get( 'params', [] ), list ):
+                d = defer.succeed( RPCFault( FAULT_INVALID_PARAMS, 'invalid call' ) )
+            elif not call['methodName'] in self.subscribed_methods:
+                d = defer.succeed( RPCFault( FAULT_METHOD_NOT_FOUND, 'method not implemented' ) )
+            else:
+                d = self.subscribed_methods[ call['methodName'] ].call( iq, call.get( 'params', [] ) )
+
+            calls.append( d )
+
+        def getResults( results ):
+            response = []
+            for result in results:
+                if isinstance( result, RPCFault ):
+                    response.append( { 'faultCode': result.error_code, 'faultString': result.error_string } )
+                else:
+                    response.append( [ result ] )
+
+            return response
+
+        return defer.gatherResults( calls ).addCallback( getResults )
+
+    def cacheResult(self, method_result, cache, cache_key):
+        """
+        Serialize a successful method_result once and keep it in cache.
+        """
+        if isinstance( method_result, RPCFault ):
+            return method_result
+
+        try:
+            cached_response = CachedResponse( MethodResponse( None, method_result ) )
+        except ( TypeError, OverflowError, UnicodeError ):
+            # sendResult answers with a fault
+            return method_result
+
+        cache.set( cache_key, cached_response )
+        return cached_response
+
+    def sendResult(self, method_result, iq):
+        if isinstance( method_result, CachedResponse ):
+            self.xmlstream.send( method_result.render( iq.getAttribute('id'), iq.getAttribute('from') ) )
+            return
 
         if isinstance( method_result, RPCFault ):
             response_iq = FaultResponse( self.xmlstream, method_result.error_code, method_result.error_string )
         else:
-            response_iq = MethodResponse( self.xmlstream, method_result )
+            try:
+                response_iq = MethodResponse( self.xmlstream, method_result )
+            except ( TypeError, OverflowError, UnicodeError ):
+                log.err( None, 'unable to encode the result for %s' % iq.getAttribute('from') )
+                response_iq = FaultResponse( self.xmlstream, FAULT_INTERNAL_ERROR, 'unable to encode result' )
 
         response_iq['id'] = iq.getAttribute('id')
         response_iq['to'] = iq.getAttribute('from')
         response_iq.send()
 
-    def callMethod(self, recipient, method_name, params ):
+    def sendFault(self, iq, error_code, error_string):
+        err_iq = FaultResponse( self.xmlstream, error_code, error_string )
+        err_iq['id'] = iq.getAttribute('id')
+        err_iq['to'] = iq.getAttribute('from')
+        err_iq.send()
+
+    def callMethod(self, recipient, method_name, params = (), timeout = None ):
+        """
+        Call method_name on the recipient JID. Returns a deferred firing with
+        the decoded result, or failing with RPCExceptionFault for a fault and
+        RPCExceptionTimeout when there was no answer within timeout seconds,
+        call_timeout by default.
+
+        At most max_in_flight calls to a recipient are sent and unanswered at
+        once; the others wait for their turn, which counts towards their
+        timeout.
+        """
+        log.msg( 'callMethod', level = logging.DEBUG )
+        log.msg( tuple( params ), level = logging.DEBUG )
+
+        q = domish.Element( ( NS_RPC, 'query') )
+        q.addElement( (None, 'methodName' ), content = str( method_name ) )
+        q.addChild( paramsToElement( params ) )
+
+        return self.sendRequest( recipient, q, timeout ).addCallback( lambda response: response[0] )
+
+    def callMethods(self, recipient, calls, timeout = None ):
+        """
+        Make the calls, a sequence of ( method_name, params ), on the recipient
+        JID with a single system.multicall. Returns a deferred firing with the
+        list of their results, holding an RPCExceptionFault for each call that
+        failed, or failing like callMethod.
+        """
+        q = domish.Element( ( NS_RPC, 'query') )
+        q.addElement( (None, 'methodName' ), content = 'system.multicall' )
+        q.addChild( paramsToElement( ( [ { 'methodName': method_name, 'params': list( params ) } for method_name, params in calls ], ) ) )
+
+        def getResults( response ):
+            if not isinstance( response[0], list ) or len( response[0] ) != len( calls ):
+                raise RPCExceptionInvalid( 'invalid system.multicall response' )
+
+            results = []
+            for result in response[0]:
+                if isinstance( result, dict ) and 'faultCode' in result:
+                    results.append( RPCExceptionFault( result['faultCode'], result.get( 'faultString', '' ) ) )
+                elif isinstance( result, list ) and len( result ) == 1:
+                    results.append( result[0] )
+                else:
+                    raise RPCExceptionInvalid( 'invalid system.multicall response' )
+
+            return results
+
+        return self.sendRequest( recipient, q, timeout ).addCallback( getResults )
+
+    def sendRequest(self, recipient, query, timeout = None):
+        if timeout is None:
+            timeout = self.call_timeout
+
+        if self.xmlstream is None:
+            return defer.fail( RPCException( 'not connected' ) )
+
+        request = RPCRequest( recipient.full(), query, reactor.seconds() + timeout )
+
+        if not request.recipient in self.peers:
+            self.peers[ request.recipient ] = RPCPeer()
+
+        peer = self.peers[ request.recipient ]
+
+        if peer.in_flight < self.max_in_flight:
+            self.sendQuery( peer, request )
+        else:
+            peer.pending.append( request )
+            request.timer = reactor.callLater( timeout, self.requestTimedOut, peer, request )
+
+        return request.deferred
+
+    def sendQuery(self, peer, request):
+        peer.in_flight += 1
 
         new_iq = xmlstream.IQ( self.xmlstream, 'set' )
-        new_iq['to'] = recipient.full()
+        new_iq['to'] = request.recipient
+        new_iq.addChild( request.query )
+        new_iq.timeout = max( request.deadline - reactor.seconds(), 0.001 )
 
-        q = new_iq.addElement( ( NS_RPC, 'query') )
-        q.addElement( (None, 'methodName' ), content = str( method_name ) )
+        new_iq.send().addCallbacks( self.decodeResponse, self.requestFailed ).addBoth( self.requestDone, peer, request )
 
-        params_dom = xml.dom.minidom.parseString( xmlrpclib.dumps( tuple( params ), allow_none = True ) )
-        removeWhitespaceNodes( params_dom )
-        q.addRawXml( params_dom.documentElement.toxml( 'utf-8' ) )
+    def sendPending(self, peer):
+        """
+        Send the waiting calls of peer that fit in its window, or fail all of
+        them once we are no longer connected.
+        """
+        while peer.pending and ( self.xmlstream is None or peer.in_flight < self.max_in_flight ):
+            request = peer.pending.popleft()
 
-        log.msg( 'callMethod', level = logging.DEBUG )
-        log.msg( tuple( params ), level = logging.DEBUG )
-        log.msg( xmlrpclib.dumps( tuple( params ), allow_none = True ), level = logging.DEBUG )
+            if request.timer and request.timer.active():
+                request.timer.cancel()
+
+            if self.xmlstream is None:
+                request.deferred.errback( RPCException( 'not connected' ) )
+            else:
+                self.sendQuery( peer, request )
+
+    def releasePeer(self, recipient, peer):
+        """
+        Forget an idle peer, unless it was already replaced by a new one.
+        """
+        if not peer.in_flight and not peer.pending and self.peers.get( recipient ) is peer:
+            del self.peers[ recipient ]
 
-        return new_iq.send()
+    def decodeResponse(self, iq):
+        """
+        Return the params of a method response as a tuple or raise its fault
+        as RPCExceptionFault.
+        """
+        if iq.query is None or iq.query.methodResponse is None:
+            raise RPCExceptionInvalid( 'missing methodResponse' )
 
-    def subscribeMethod(self, method_name, method ):
-        self.subscribed_methods[ method_name ] = method
+        response = iq.query.methodResponse
+
+        decoder = RPCDecoder( self.max_depth, self.max_values, self.max_size )
+
+        if response.fault is not None:
+            fault = decoder.decodeValue( decoder.getOnlyChild( response.fault, 'value' ), 0 )
+
+            if not isinstance( fault, dict ):
+                raise RPCExceptionInvalid( 'invalid fault' )
+
+            raise RPCExceptionFault( fault.get( 'faultCode' ), fault.get( 'faultString', '' ) )
+
+        # peers from before params were put in methodResponse send them next
+        # to it
+        params = decoder.decodeParams( response.params or iq.query.params )
+
+        if len( params ) != 1:
+            raise RPCExceptionInvalid( 'method response must hold a single param' )
+
+        return params
+
+    def requestFailed(self, reason):
+        reason.trap( xmlstream.TimeoutError )
+        raise RPCExceptionTimeout( 'timed out' )
+
+    def requestDone(self, result, peer, request):
+        peer.in_flight -= 1
+
+        self.sendPending( peer )
+        self.releasePeer( request.recipient, peer )
+
+        request.deferred.callback( result )
+
+    def requestTimedOut(self, peer, request):
+        peer.pending.remove( request )
+        self.releasePeer( request.recipient, peer )
+
+        request.deferred.errback( RPCExceptionTimeout( 'timed out' ) )
+
+    def subscribeMethod(self, method_name, method, threaded = False, timeout = 60, max_running = 4, max_queued = 100, cache_ttl = None, cache_size = 128 ):
+        """
+        Serve method_name with method( iq, *params ), which returns the result,
+        an RPCFault or a deferred firing with either. See RPCMethod for the
+        other options.
+
+        With cache_ttl set, the serialized response to a call is reused for
+        calls with the same params over the next cache_ttl seconds, for up to
+        cache_size distinct params. Only use it for methods without side
+        effects whose result does not depend on the caller.
+        """
+        rpc_method = RPCMethod( method, threaded, timeout, max_running, max_queued )
+
+        if cache_ttl is not None:
+            rpc_method.cache = RPCResponseCache( cache_ttl, cache_size, rpc_method.clock )
+
+        self.subscribed_methods[ method_name ] = rpc_method
 
     def unsubscribeMethod(self, method_name):
         if method_name in self.subscribed_methods:
             del self.subscribed_methods[ method_name ]
 
+class RPCPeer( object ):
+    __slots__ = ( 'in_flight', 'pending' )
+
+    def __init__(self):
+        self.in_flight = 0
+        self.pending = collections.deque()
+
+class RPCRequest( object ):
+    __slots__ = ( 'recipient', 'query', 'deadline', 'deferred', 'timer' )
+
+    def __init__(self, recipient, query, deadline):
+        self.recipient = recipient
+        self.query = query
+        self.deadline = deadline
+        self.deferred = defer.Deferred()
+        self.timer = None
+
+class RPCCall( object ):
+    __slots__ = ( 'args', 'deferred', 'running', 'timer' )
+
+    def __init__(self, args):
+        self.args = args
+        self.deferred = defer.Deferred()
+        self.running = None
+        self.timer = None
+
+class RPCMethod( object ):
+    """
+    A subscribed method and the way it is called. A threaded method runs in
+    the RPC thread pool instead of on the reactor thread. At most max_running
+    calls run at once, None for no limit; up to max_queued more wait and any
+    beyond that are answered with a fault at once. A call not answered within
+    timeout seconds, None for no limit, of arriving is answered with a fault;
+    a running deferred is cancelled, a running thread is left to finish.
+    """
+    thread_pool = None
+    thread_pool_size = 4
+
+    def __init__(self, method, threaded = False, timeout = 60, max_running = 4, max_queued = 100, clock = reactor):
+        self.method = method
+        self.threaded = threaded
+        self.timeout = timeout
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.clock = clock
+        self.running = 0
+        self.pending = collections.deque()
+        self.cache = None
+
+    @classmethod
+    def getThreadPool(cls):
+        if cls.thread_pool is None:
+            cls.thread_pool = threadpool.ThreadPool( 1, cls.thread_pool_size, 'RPCMethod' )
+            cls.thread_pool.start()
+            reactor.addSystemEventTrigger( 'during', 'shutdown', cls.thread_pool.stop )
+
+        return cls.thread_pool
+
+    def call(self, iq, params):
+        """
+        Returns a deferred firing with the result of the method, or an
+        RPCFault.
+        """
+        rpc_call = RPCCall( ( iq, ) + tuple( params ) )
+
+        if self.max_running is None or self.running < self.max_running:
+            self.start( rpc_call )
+        elif len( self.pending ) < self.max_queued:
+            self.pending.append( rpc_call )
+        else:
+            log.msg( 'RPCMethod: queue full', level = logging.DEBUG )
+            return defer.succeed( RPCFault( FAULT_BUSY, 'too many calls' ) )
+
+        if self.timeout is not None and not rpc_call.deferred.called:
+            rpc_call.timer = self.clock.callLater( self.timeout, self.timedOut, rpc_call )
+
+        return rpc_call.deferred
+
+    def start(self, rpc_call):
+        self.running += 1
+
+        if self.threaded:
+            rpc_call.running = threads.deferToThreadPool( reactor, self.getThreadPool(), self.method, *rpc_call.args )
+        else:
+            rpc_call.running = defer.maybeDeferred( self.method, *rpc_call.args )
+
+        rpc_call.running.addErrback( self.failed ).addCallback( self.done, rpc_call )
+
+    def failed(self, reason):
+        if reason.check( defer.CancelledError ):
+            return RPCFault( FAULT_TIMEOUT, 'timed out' )
+
+        log.err( reason, 'RPC method failed' )
+        return RPCFault( FAULT_INTERNAL_ERROR, 'internal error' )
+
+    def done(self, result, rpc_call):
+        self.running -= 1
+        self.answer( rpc_call, result )
+
+        while self.pending and ( self.max_running is None or self.running < self.max_running ):
+            self.start( self.pending.popleft() )
+
+    def answer(self, rpc_call, result):
+        if rpc_call.deferred.called:
+            return
+
+        if rpc_call.timer and rpc_call.timer.active():
+            rpc_call.timer.cancel()
+
+        rpc_call.deferred.callback( result )
+
+    def timedOut(self, rpc_call):
+        log.msg( 'RPCMethod: call timed out', level = logging.DEBUG )
+        self.answer( rpc_call, RPCFault( FAULT_TIMEOUT, 'timed out' ) )
+
+        if rpc_call in self.pending:
+            self.pending.remove( rpc_call )
+        elif not self.threaded:
+            rpc_call.running.cancel()
+
+class RPCResponseCache( object ):
+    """
+    Keeps the CachedResponse for up to max_entries keys, each for ttl seconds,
+    dropping the least recently used key first.
+    """
+
+    def __init__(self, ttl, max_entries = 128, clock = reactor):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.pop( key, None )
+
+        if entry is None or entry[0] <= self.clock.seconds():
+            self.misses += 1
+            return None
+
+        self.entries[ key ] = entry
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, cached_response):
+        self.entries.pop( key, None )
+        self.entries[ key ] = ( self.clock.seconds() + self.ttl, cached_response )
+
+        while len( self.entries ) > self.max_entries:
+            self.entries.popitem( last = False )
+
+    def clear(self):
+        self.entries.clear()
+
+class CachedResponse( object ):
+    """
+    A method response serialized once, so answering another call with it only
+    splices in the id and recipient of the call.
+    """
+
+    def __init__(self, response_iq):
+        self.payload = response_iq.query.toXml()
+
+    def render(self, stanza_id, recipient):
+        attributes = [ u"<iq type='result'" ]
+
+        if stanza_id is not None:
+            attributes.append( u" id='%s'" % domish.escapeToXml( stanza_id, 1 ) )
+
+        if recipient is not None:
+            attributes.append( u" to='%s'" % domish.escapeToXml( recipient, 1 ) )
+
+        return u''.join( attributes ) + u'>' + self.payload + u'</iq>'
+
 class RPCFault( object ):
 
     def __init__(self, error_code, error_string):
@@ -116,40 +537,276 @@ class MethodResponse( xmlstream.IQ ):
         xmlstream.IQ.__init__(self, stream, 'result')
 
         q = self.addElement( ( NS_RPC, 'query') )
-        q.addElement( ( None, 'methodResponse') )
-
-        params_dom = xml.dom.minidom.parseString( xmlrpclib.dumps( ( params, ), allow_none = True ) )
-        removeWhitespaceNodes( params_dom )
-        q.addRawXml( params_dom.documentElement.toxml( 'utf-8' ) )
-
-def objectToElement( item ):
-
-    if isinstance( item, type( () ) ) or isinstance( item, type( [] ) ) and len( item ):
-        new_ele = domish.Element( (None, 'array') )
-        d = new_ele.addElement( (None, 'data') )
-        for x in item:
-            d.addElement( (None, 'value') ).addChild( objectToElement( x ) )
-    elif isinstance( item, type( {} ) ):
-        new_ele = domish.Element( (None, 'struct') )
-        for name, value in item.items():
-            if not isinstance( name, type( str() ) ):
-                continue
-            m = new_ele.addElement( (None, 'member') )
-            m.addElement( (None, 'name'), content = str( name ) )
-            m.addElement( (None, 'value') ).addChild( objectToElement( value ) )
+        q.addElement( ( None, 'methodResponse') ).addChild( paramsToElement( ( params, ) ) )
+
+def paramsToElement( params ):
+    """
+    Return the XML-RPC params element for the sequence params.
+    """
+    new_ele = domish.Element( (None, 'params') )
+
+    for param in params:
+        new_ele.addElement( (None, 'param') ).addElement( (None, 'value') ).addChild( objectToElement( param ) )
+
+    return new_ele
+
+def objectToElement( item, memo = None ):
+    """
+    Return the XML-RPC element for item, built directly in domish and
+    accepting what xmlrpclib.dumps( ..., allow_none = True ) does: None,
+    booleans, ints, floats, strings, unicode, lists, tuples, dicts with string
+    keys, datetimes, xmlrpclib.DateTime, xmlrpclib.Binary and instances, as
+    structs of their attributes.
+    """
+    if memo is None:
+        memo = set()
+
+    if item is None:
+        new_ele = domish.Element( (None, 'nil') )
     elif item is True or item is False:
         new_ele = domish.Element( (None, 'boolean') )
         new_ele.addContent( ( item and '1' ) or '0' )
-    elif isinstance( item, type( int() ) ):
+    elif isinstance( item, ( int, long ) ):
+        if item > MAXINT or item < MININT:
+            raise OverflowError( 'int exceeds XML-RPC limits' )
+
         new_ele = domish.Element( (None, 'int') )
-        new_ele.addContent( str( item ) )
-    elif isinstance( item, type( float() ) ):
+        new_ele.addContent( str( int( item ) ) )
+    elif isinstance( item, float ):
         new_ele = domish.Element( (None, 'double') )
-        new_ele.addContent( str( item ) )
-    else:
+        new_ele.addContent( repr( item ) )
+    elif isinstance( item, unicode ):
+        new_ele = domish.Element( (None, 'string') )
+        new_ele.addContent( item )
+    elif isinstance( item, str ):
         new_ele = domish.Element( (None, 'string') )
-        new_ele.addContent( str( item ) )
+        new_ele.addContent( item.decode( 'utf-8' ) )
+    elif isinstance( item, datetime.datetime ):
+        new_ele = domish.Element( (None, 'dateTime.iso8601') )
+        new_ele.addContent( item.strftime( '%Y%m%dT%H:%M:%S' ) )
+    elif isinstance( item, xmlrpclib.DateTime ):
+        new_ele = domish.Element( (None, 'dateTime.iso8601') )
+        new_ele.addContent( item.value )
+    elif isinstance( item, xmlrpclib.Binary ):
+        new_ele = domish.Element( (None, 'base64') )
+        new_ele.addContent( base64.b64encode( item.data ) )
+    elif isinstance( item, ( tuple, list, dict ) ) or hasattr( item, '__dict__' ):
+        item_id = id( item )
+
+        if item_id in memo:
+            raise TypeError( 'cannot marshal recursive sequences' )
+
+        memo.add( item_id )
+
+        if isinstance( item, ( tuple, list ) ):
+            new_ele = domish.Element( (None, 'array') )
+            d = new_ele.addElement( (None, 'data') )
+            for x in item:
+                d.addElement( (None, 'value') ).addChild( objectToElement( x, memo ) )
+        else:
+            if not isinstance( item, dict ):
+                item = vars( item )
+
+            new_ele = domish.Element( (None, 'struct') )
+            for name, value in item.items():
+                if not isinstance( name, basestring ):
+                    raise TypeError( 'dictionary key must be string' )
+                m = new_ele.addElement( (None, 'member') )
+                m.addElement( (None, 'name'), content = isinstance( name, unicode ) and name or name.decode( 'utf-8' ) )
+                m.addElement( (None, 'value') ).addChild( objectToElement( value, memo ) )
+
+        memo.remove( item_id )
+    else:
+        raise TypeError( 'cannot marshal %s objects' % type( item ) )
 
     return new_ele
 
+class RPCException( Exception ):
+    pass
+
+class RPCExceptionInvalid( RPCException ):
+    pass
+
+class RPCExceptionTimeout( RPCException ):
+    pass
+
+class RPCExceptionFault( RPCException ):
+
+    def __init__(self, fault_code, fault_string):
+        RPCException.__init__( self, fault_code, fault_string )
+        self.fault_code = fault_code
+        self.fault_string = fault_string
+
+def cacheKey( item ):
+    """
+    Return a hashable key for the decoded params item that tells apart values
+    of different XML-RPC types.
+    """
+    if isinstance( item, ( list, tuple ) ):
+        return ( 'array', ) + tuple( cacheKey( value ) for value in item )
+
+    if isinstance( item, dict ):
+        return ( 'struct', ) + tuple( sorted( ( key, cacheKey( value ) ) for key, value in item.iteritems() ) )
+
+    if isinstance( item, xmlrpclib.Binary ):
+        return ( 'base64', item.data )
+
+    if isinstance( item, xmlrpclib.DateTime ):
+        return ( 'dateTime', item.value )
+
+    return ( type( item ), item )
+
+def getText( element ):
+    return u''.join( child for child in element.children if isinstance( child, basestring ) )
+
+def stringify( text ):
+    """
+    Return ascii text as a str, like xmlrpclib does.
+    """
+    try:
+        return text.encode( 'ascii' )
+    except UnicodeError:
+        return text
+
+class RPCDecoder( object ):
+    """
+    Turns XML-RPC params elements, as parsed by the xml stream, straight into
+    the values xmlrpclib.loads would return for them, without serializing and
+    parsing them again.
+
+    Anything not valid XML-RPC raises RPCExceptionInvalid, as does nesting arrays
+    and structs deeper than max_depth, more than max_values values or more
+    than max_size characters of text.
+    """
+
+    def __init__(self, max_depth = 32, max_values = 10000, max_size = 1048576):
+        self.max_depth = max_depth
+        self.max_values = max_values
+        self.max_size = max_size
+        self.values = 0
+        self.size = 0
+
+    def decodeParams(self, params):
+        """
+        Return the tuple of values of the params element, which may be None
+        for a call without params.
+        """
+        if params is None:
+            return ()
+
+        result = []
+        for param in params.elements():
+            if param.name != 'param':
+                raise RPCExceptionInvalid( 'unexpected %s in params' % param.name )
+
+            result.append( self.decodeValue( self.getOnlyChild( param, 'value' ), 0 ) )
+
+        return tuple( result )
+
+    def getOnlyChild(self, element, name):
+        children = list( element.elements() )
+
+        if len( children ) != 1 or children[0].name != name:
+            raise RPCExceptionInvalid( '%s must hold a single %s' % ( element.name, name ) )
+
+        return children[0]
+
+    def getText(self, element):
+        text = getText( element )
+        self.size += len( text )
+
+        if self.size > self.max_size:
+            raise RPCExceptionInvalid( 'params too large' )
+
+        return text
+
+    def decodeValue(self, value, depth):
+        self.values += 1
+
+        if self.values > self.max_values:
+            raise RPCExceptionInvalid( 'too many values' )
+
+        children = list( value.elements() )
+
+        # a value without a type is a string
+        if not children:
+            return stringify( self.getText( value ) )
+
+        if len( children ) != 1:
+            raise RPCExceptionInvalid( 'value must hold a single type' )
+
+        typed = children[0]
+        name = typed.name
+
+        if name in ( 'array', 'struct' ):
+            if depth >= self.max_depth:
+                raise RPCExceptionInvalid( 'params nested too deep' )
+
+            if name == 'array':
+                return [ self.decodeValue( item, depth + 1 ) for item in self.getArrayValues( typed ) ]
+
+            return self.decodeStruct( typed, depth + 1 )
+
+        if list( typed.elements() ) and name != 'nil':
+            raise RPCExceptionInvalid( '%s must not hold elements' % name )
+
+        if name == 'nil':
+            return None
+
+        text = self.getText( typed )
+
+        try:
+            if name in ( 'int', 'i4', 'i8' ):
+                return int( text.strip() )
+            elif name == 'boolean':
+                if not text.strip() in ( '0', '1' ):
+                    raise ValueError( text )
+                return text.strip() == '1'
+            elif name == 'double':
+                return float( text.strip() )
+            elif name == 'string':
+                return stringify( text )
+            elif name == 'dateTime.iso8601':
+                return xmlrpclib.DateTime( text.strip().encode( 'ascii' ) )
+            elif name == 'base64':
+                return xmlrpclib.Binary( base64.b64decode( text.encode( 'ascii' ) ) )
+        except ( ValueError, TypeError, UnicodeError ):
+            raise RPCExceptionInvalid( 'invalid %s' % name )
+
+        raise RPCExceptionInvalid( 'unknown type %s' % name )
+
+    def getArrayValues(self, array):
+        data = self.getOnlyChild( array, 'data' )
+
+        for item in data.elements():
+            if item.name != 'value':
+                raise RPCExceptionInvalid( 'unexpected %s in array' % item.name )
+
+            yield item
+
+    def decodeStruct(self, struct, depth):
+        result = {}
+
+        for member in struct.elements():
+            if member.name != 'member':
+                raise RPCExceptionInvalid( 'unexpected %s in struct' % member.name )
+
+            name = None
+            value = None
+
+            for child in member.elements():
+                if child.name == 'name' and name is None:
+                    name = stringify( self.getText( child ) )
+                elif child.name == 'value' and value is None:
+                    value = child
+                else:
+                    raise RPCExceptionInvalid( 'unexpected %s in member' % child.name )
+
+            if name is None or value is None:
+                raise RPCExceptionInvalid( 'member must hold a name and a value' )
+
+            result[ name ] = self.decodeValue( value, depth )
+
+        return result
+
 CommonClientManager.addHandler( 'rpc', RPCProtocolHandler )
@@ -1,14 +1,14 @@
-import ConfigParser, subprocess, os, time
-from twisted.python import log
+import ConfigParser, os, time, collections, math, fnmatch, string
+from twisted.python import log, failure
 from twisted.internet import threads, defer, reactor
 from wokkel.subprotocols import XMPPHandler
 from datetime import datetime
 from twisted.words.protocols.jabber import jid
-from twisted.words.xish import domish
+from twisted.words.xish import domish, xpath
 import pyinotify, logging, re
 
 from plugins.inotify_handler import INotifyHandler
-from common import CommonClientManager
+from common import CommonClientManager, TimerScheduler, CronSchedule, CronScheduleException, ProcessExecutor, SendQueue, SendQueueException
 
 TRIGGER_CONFIG_FILE_DEFAULT = 'triggers.ini'
 
@@ -27,111 +27,412 @@ class TriggerHandler( XMPPHandler ):
         super( TriggerHandler, self ).__init__()
 
         self.my_client = client
+        self.scheduler = TimerScheduler()
+        self.send_queue = SendQueue( room_ready = self.isInRoom )
+        self.coalescer = MessageCoalescer( self.scheduler, self.send_queue )
+        self.trigger_config = trigger_config
+
+        self.config = {}
+        self.triggers = {}
+        self.trigger_configs = {}
+        self.event_index = {}
+        self.xpath_groups = {}
+        self.inotify_handler = None
+        self.config_stat = None
+        self.send_limits = None
+
+        general, trigger_configs = self.readConfig()
+        self.applyGeneralConfig( general )
+
+        for name, options in trigger_configs.items():
+            self.addTrigger( self.buildTrigger( name, options ) )
+
+        self.trigger_configs = trigger_configs
+        self.scheduleConfigCheck()
+
+    def readConfig(self, required = False):
+        """
+        Return the [general] options and the options of every trigger section,
+        keyed by section name. When required, a file that is missing,
+        unreadable or without sections, as while it is being rewritten, raises
+        TriggerException instead of reading as no triggers.
+        """
+        self.config_stat = getFileStat( self.trigger_config )
 
         config = ConfigParser.ConfigParser()
-        config.read( trigger_config )
 
-        config_triggers = {}
+        if not config.read( self.trigger_config ) and required:
+            raise TriggerException( 'unable to read %s' % self.trigger_config )
+
+        if not config.sections() and required:
+            raise TriggerException( '%s holds no sections' % self.trigger_config )
+
+        general = {}
+        if config.has_section( 'general' ):
+            general = dict( config.items( 'general' ) )
+
+        trigger_configs = {}
         for section in config.sections():
             options = dict( config.items( section ) )
 
             if not 'type' in options:
                 continue
 
-            if not options['type'] in config_triggers:
-                config_triggers[ options['type'] ] = {}
+            if not options['type'] in TRIGGER_TYPES:
+                log.msg( 'Unknown trigger type %s for %s' % ( options['type'], section ), level = logging.DEBUG )
+                continue
+
+            trigger_configs[ section ] = options
+
+        return general, trigger_configs
+
+    def applyGeneralConfig(self, general):
+        try:
+            FileTriggerContent.cache.max_bytes = int( general.get( 'file_cache_max_bytes', FileTriggerContent.cache.max_bytes ) )
+            FileTriggerContent.cache.revalidate_interval = float( general.get( 'file_cache_revalidate_interval', FileTriggerContent.cache.revalidate_interval ) )
+            ExternalTriggerContent.executor.max_running = int( general.get( 'external_max_running', ExternalTriggerContent.executor.max_running ) )
+            ExternalTriggerContent.executor.max_queued = int( general.get( 'external_max_queued', ExternalTriggerContent.executor.max_queued ) )
+            config_check_interval = float( general.get( 'config_check_interval', 5 ) )
+
+            self.send_queue.max_size = int( general.get( 'send_queue_size', 1000 ) )
+            send_limits = ( float( general.get( 'send_rate', 5 ) ),
+                            float( general.get( 'send_burst', 10 ) ),
+                            float( general.get( 'send_recipient_rate', 1 ) ),
+                            float( general.get( 'send_recipient_burst', 5 ) ),
+                            float( general.get( 'send_room_rate', 1 ) ),
+                            float( general.get( 'send_room_burst', 5 ) ) )
+
+            # setting the limits refills the token buckets
+            if send_limits != self.send_limits:
+                self.send_queue.setLimits( *send_limits )
+                self.send_limits = send_limits
+
+            self.coalescer.window = float( general.get( 'coalesce_window', 0 ) )
+            self.coalescer.max_size = int( general.get( 'coalesce_max_size', 4096 ) )
+            self.coalescer.separator = general.get( 'coalesce_separator', r'\n' ).decode( 'string_escape' )
+        except ( ValueError, SendQueueException ):
+            raise TriggerException( 'invalid general options' )
+
+        self.config = general
+        self.config_check_interval = config_check_interval
+
+    def buildTrigger(self, name, options):
+        trigger = TRIGGER_TYPES[ options['type'] ]( self, name, options )
+        trigger.action.validate()
+        return trigger
+
+    def addTrigger(self, trigger):
+        self.triggers[ trigger.name ] = trigger
+
+        if isinstance( trigger, ScheduledTrigger ):
+            self.scheduled_triggers.append( trigger )
+            trigger.schedule()
+        elif isinstance( trigger, TimedTrigger ):
+            self.timed_triggers.append( trigger )
+            trigger.schedule()
+        elif isinstance( trigger, EventTrigger ):
+            self.addEventTrigger( trigger )
+        elif isinstance( trigger, XPathTrigger ):
+            self.addXPathTrigger( trigger )
+        elif isinstance( trigger, FilesystemTrigger ):
+            self.fs_triggers.append( trigger )
+
+            if not self.inotify_handler:
+                self.inotify_handler = INotifyHandler()
+
+            self.inotify_handler.addTrigger( trigger )
+
+    def removeTrigger(self, trigger):
+        """
+        Undo addTrigger, cancelling the timers, observers and watches held for
+        the trigger and dropping its queued work.
+        """
+        del self.triggers[ trigger.name ]
+        trigger.cancel()
+        trigger.queue.clear()
+
+        if isinstance( trigger, ScheduledTrigger ):
+            self.scheduled_triggers.remove( trigger )
+        elif isinstance( trigger, TimedTrigger ):
+            self.timed_triggers.remove( trigger )
+        elif isinstance( trigger, EventTrigger ):
+            self.removeEventTrigger( trigger )
+        elif isinstance( trigger, XPathTrigger ):
+            self.removeXPathTrigger( trigger )
+        elif isinstance( trigger, FilesystemTrigger ):
+            self.fs_triggers.remove( trigger )
+            self.inotify_handler.removeTrigger( trigger )
+
+    def scheduleConfigCheck(self):
+        if self.config_check_interval > 0:
+            self.scheduler.callLater( self.config_check_interval, self.checkConfig )
+
+    def checkConfig(self):
+        if getFileStat( self.trigger_config ) != self.config_stat:
+            self.reloadConfig()
+
+        self.scheduleConfigCheck()
+
+    def reloadConfig(self):
+        """
+        Apply the differences between the trigger config file and the running
+        triggers. Only sections that were added, changed or removed are
+        touched; unchanged triggers keep their state. A changed section that no
+        longer builds leaves its running trigger in place.
+        """
+        log.msg( 'TriggerHandler: reloading %s' % self.trigger_config, level = logging.DEBUG )
+
+        try:
+            general, trigger_configs = self.readConfig( True )
+            self.applyGeneralConfig( general )
+        except ( ConfigParser.Error, TriggerException ):
+            log.err( None, 'Unable to reload %s, keeping the running triggers' % self.trigger_config )
+            return
+
+        built = {}
+        for name, options in trigger_configs.items():
+            if self.trigger_configs.get( name ) == options:
+                continue
+
+            try:
+                built[ name ] = self.buildTrigger( name, options )
+            except Exception:
+                log.err( None, 'Unable to build trigger %s' % name )
+
+                if name in self.trigger_configs:
+                    trigger_configs[ name ] = self.trigger_configs[ name ]
+                else:
+                    del trigger_configs[ name ]
+
+        removed = [ name for name in self.trigger_configs if not name in trigger_configs or name in built ]
+
+        for name in removed:
+            self.removeTrigger( self.triggers[ name ] )
+
+        for trigger in built.values():
+            self.addTrigger( trigger )
+
+        self.trigger_configs = trigger_configs
+        log.msg( 'TriggerHandler: reloaded, %d triggers removed, %d added' % ( len( removed ), len( built ) ) )
 
-            config_triggers[ options['type'] ][ section ] = options
+    def addEventTrigger( self, trigger ):
+        """
+        Event triggers are indexed by event type and by the string form of their
+        source entity, so an incoming stanza only visits the triggers that can
+        possibly match its sender.
+        """
+        self.event_triggers.append( trigger )
+
+        if not trigger.event_type in self.event_index:
+            self.event_index[ trigger.event_type ] = {}
+
+            if self.xmlstream:
+                self.xmlstream.addObserver( '/' + trigger.event_type, self.checkEvent, event_type = trigger.event_type )
 
-        scheduled   = config_triggers.get( 'scheduled', [] )
-        timed       = config_triggers.get( 'timed', [] )
-        event       = config_triggers.get( 'event', [] )
-        my_fs       = config_triggers.get( 'filesystem', [] )
+        sources = self.event_index[ trigger.event_type ]
+        source_key = trigger.event.source_entity.full()
 
-        log.msg( my_fs, level = logging.DEBUG )
+        if not source_key in sources:
+            sources[ source_key ] = EventTriggerGroup( trigger.event_type )
 
-        for trigger in scheduled:
-            self.scheduled_triggers.append( ScheduledTrigger( self, trigger, scheduled[ trigger ] ) )
+        sources[ source_key ].addTrigger( trigger )
 
-        for trigger in timed:
-            self.timed_triggers.append( TimedTrigger( self, trigger, timed[ trigger ] ) )
+    def removeEventTrigger( self, trigger ):
+        self.event_triggers.remove( trigger )
+
+        sources = self.event_index[ trigger.event_type ]
+        source_key = trigger.event.source_entity.full()
+        sources[ source_key ].removeTrigger( trigger )
+
+        if len( sources[ source_key ] ):
+            return
+
+        del sources[ source_key ]
+
+        if not sources:
+            del self.event_index[ trigger.event_type ]
+
+            if self.xmlstream:
+                self.xmlstream.removeObserver( '/' + trigger.event_type, self.checkEvent )
+
+    def addXPathTrigger( self, trigger ):
+        """
+        XPath triggers are grouped by the first step of their expression, so
+        each distinct first step is evaluated by a single xmlstream observer and
+        each distinct expression only once per stanza.
+        """
+        self.xpath_triggers.append( trigger )
 
-        for trigger in event:
-            self.event_triggers.append( EventTrigger( self, trigger, event[ trigger ] ) )
+        if not trigger.root_expression in self.xpath_groups:
+            self.xpath_groups[ trigger.root_expression ] = XPathTriggerGroup( trigger.root_expression )
 
-        for trigger in my_fs:
-            self.fs_triggers.append( FilesystemTrigger( self, trigger, my_fs[ trigger ] ) )
+            if self.xmlstream:
+                self.xmlstream.addObserver( trigger.root_expression, self.xpath_groups[ trigger.root_expression ].checkElement )
 
-        if len( self.scheduled_triggers ):
-            reactor.callLater( 60, self.checkScheduled )
+        self.xpath_groups[ trigger.root_expression ].addTrigger( trigger )
 
-        if len( self.timed_triggers ):
-            reactor.callLater( 60, self.checkTimed )
+    def removeXPathTrigger( self, trigger ):
+        self.xpath_triggers.remove( trigger )
 
-        if len( self.fs_triggers ):
-            self.inotify_handler = INotifyHandler( self.fs_triggers )
+        group = self.xpath_groups[ trigger.root_expression ]
+        group.removeTrigger( trigger )
+
+        if len( group ):
+            return
+
+        del self.xpath_groups[ trigger.root_expression ]
+
+        if self.xmlstream:
+            self.xmlstream.removeObserver( trigger.root_expression, group.checkElement )
 
     def connectionInitialized(self):
         log.msg( 'trigger_handler: connectionInitialized', level = logging.DEBUG )
 
-        utilized_event_types = []
-        for trigger in self.event_triggers:
-            log.msg( 'init checkEvent %s' % trigger.name, level = logging.DEBUG )
-            log.msg( trigger.event.type, level = logging.DEBUG )
+        for event_type in self.event_index:
+            log.msg( 'init checkEvent %s' % event_type, level = logging.DEBUG )
+            self.xmlstream.addObserver('/' + event_type, self.checkEvent, event_type = event_type )
+
+        for root_expression, group in self.xpath_groups.items():
+            log.msg( 'init xpath %s' % root_expression, level = logging.DEBUG )
+            self.xmlstream.addObserver( root_expression, group.checkElement )
 
-            if not trigger.event.type in utilized_event_types and trigger.event_type in EVENT_TYPES:
-                utilized_event_types.append( trigger.event_type )
+        self.send_queue.connected( self.xmlstream )
 
-        if len( utilized_event_types ):
-            for event_type in utilized_event_types:
-                self.xmlstream.addObserver('/' + event_type, self.checkEvent, event_type = event_type )
+    def connectionLost(self, reason):
+        log.msg( 'trigger_handler: connectionLost', level = logging.DEBUG )
+        super( TriggerHandler, self ).connectionLost( reason )
+        self.send_queue.disconnected()
 
     def checkEvent( self, element, event_type ):
-        if not len( self.event_triggers ):
+        sources = self.event_index.get( event_type )
+        if not sources or not element.hasAttribute( 'from' ):
             return
 
-        def checkResponse( response ):
-            log.msg( 'checkResponse: %s' % trigger.name, level = logging.DEBUG )
-            trigger.check_running = False
-            if response:
-                trigger.run( element, response )
-
-        for trigger in self.event_triggers:
-            if trigger.event_type == event_type and not trigger.check_running:
-                trigger.check_running = True
-                trigger.check( element ).addCallback( checkResponse )
-
-    def checkScheduled(self):
+        try:
+            from_jid = jid.JID( element['from'] )
+        except jid.InvalidFormat:
+            log.msg( 'checkEvent: invalid from %s' % element['from'], level = logging.DEBUG )
+            return
 
-        def checkResponse( response, trigger ):
-            log.msg( 'checkResponse', level = logging.DEBUG )
-            trigger.check_running = False
-            if response:
-                trigger.run( None )
+        event_class = EVENT_TYPES[ event_type ]
+        subject = event_class.getSubject( element )
 
-        for trigger in self.scheduled_triggers:
-            if not trigger.check_running:
-                trigger.check_running = True
-                trigger.check( None ).addCallback( checkResponse, trigger )
+        for source_key in event_class.getSourceKeys( from_jid ):
+            group = sources.get( source_key )
+            if not group:
+                continue
 
-        reactor.callLater( 60, self.checkScheduled )
+            for trigger, check_response in group.matchSubject( subject ):
+                if not trigger.ran or trigger.repeat:
+                    trigger.queue.submit( element, from_jid, check_response )
 
-    def checkTimed(self):
+            for trigger in group.dynamic_triggers:
+                trigger.queue.submit( element, from_jid )
 
-        def checkResponse( response, trigger ):
-            log.msg( 'checkResponse', level = logging.DEBUG )
-            trigger.check_running = False
-            if response:
-                trigger.run( None )
+    def isInRoom(self, room):
+        """
+        Whether we are in room, a bare room JID string; without a MUC handler
+        we cannot tell and assume so.
+        """
+        muc_client = CommonClientManager.getHandler( 'muc', self.my_client )
+        return muc_client is None or muc_client.isInRoom( room )
 
-        for trigger in self.timed_triggers:
-            if not trigger.check_running:
-                trigger.check_running = True
-                trigger.check( None ).addCallback( checkResponse, trigger )
+    def getQueueStats(self):
+        """
+        Return the work queue counters of every trigger, keyed by trigger name,
+        along with their totals under 'total' and the counters of the send
+        queue under 'send'.
+        """
+        stats = { 'total': dict( ( counter, 0 ) for counter in TriggerWorkQueue.counters ), 'triggers': {}, 'send': self.send_queue.getStats() }
+
+        for triggers in [ self.scheduled_triggers, self.timed_triggers, self.event_triggers, self.xpath_triggers, self.fs_triggers ]:
+            for trigger in triggers:
+                trigger_stats = trigger.queue.getStats()
+                stats[ 'triggers' ][ trigger.name ] = trigger_stats
+
+                for counter in TriggerWorkQueue.counters:
+                    stats[ 'total' ][ counter ] += trigger_stats[ counter ]
+
+        return stats
+
+class TriggerWorkQueue( object ):
+    """
+    Processes the work of a single trigger with at most concurrency items in
+    flight. Work submitted while the limit is reached waits in a queue of at
+    most size items; once it is full the overflow policy decides what is lost:
+
+        drop-newest  the submitted work is dropped
+        drop-oldest  the longest waiting work is dropped
+        coalesce     the submitted work replaces everything waiting, so at most
+                     one item ever waits regardless of size
+    """
+    overflow_policies = [ 'drop-newest', 'drop-oldest', 'coalesce' ]
+    counters = [ 'queued', 'dropped', 'processed', 'running', 'pending' ]
+
+    def __init__(self, work, concurrency = 1, size = 10, overflow = 'drop-oldest'):
+        if not overflow in self.overflow_policies:
+            raise TriggerException( 'invalid queue overflow policy' )
+
+        if concurrency < 1 or size < 0:
+            raise TriggerException( 'invalid queue limits' )
+
+        self.work = work
+        self.concurrency = concurrency
+        self.size = size
+        self.overflow = overflow
+        self.pending = collections.deque()
+
+        self.running = 0
+        self.queued = 0
+        self.dropped = 0
+        self.processed = 0
+
+    def submit(self, *args):
+        if self.running < self.concurrency:
+            self.start( args )
+            return
 
-        reactor.callLater( 60, self.checkTimed )
+        if self.overflow == 'coalesce' and self.size:
+            self.dropped += len( self.pending )
+            self.pending.clear()
+        elif len( self.pending ) >= self.size:
+            if self.overflow != 'drop-oldest' or not self.size:
+                log.msg( 'TriggerWorkQueue: dropping new work', level = logging.DEBUG )
+                self.dropped += 1
+                return
+
+            log.msg( 'TriggerWorkQueue: dropping oldest work', level = logging.DEBUG )
+            self.pending.popleft()
+            self.dropped += 1
+
+        self.pending.append( args )
+        self.queued += 1
+
+    def start(self, args):
+        self.running += 1
+        defer.maybeDeferred( self.work, *args ).addErrback( log.err ).addBoth( self.workDone )
+
+    def workDone(self, response):
+        self.running -= 1
+        self.processed += 1
+
+        if self.pending and self.running < self.concurrency:
+            self.start( self.pending.popleft() )
+
+    def clear(self):
+        self.dropped += len( self.pending )
+        self.pending.clear()
+
+    def getStats(self):
+        return { 'queued': self.queued,
+                 'dropped': self.dropped,
+                 'processed': self.processed,
+                 'running': self.running,
+                 'pending': len( self.pending ),
+               }
 
 class Trigger( object ):
+    default_queue_overflow = 'drop-oldest'
 
     def __init__(self, handler, name, config):
 
@@ -139,9 +440,8 @@ class Trigger( object ):
         self.name = name
         self.config = config
         self.ran = False
-        self.check_running = False
 
-        self.repeat = self.config.get( 'repeat', False )
+        self.repeat = getBoolean( self.config, 'repeat' )
 
         self.allowed_role = self.config.get( 'allowed_role', 'any' )
 
@@ -153,13 +453,47 @@ class Trigger( object ):
 
         self.action = ACTION_TYPES[ self.config['action_type'] ]( self )
 
+        try:
+            self.queue = TriggerWorkQueue( self.process,
+                                           int( self.config.get( 'queue_concurrency', 1 ) ),
+                                           int( self.config.get( 'queue_size', 10 ) ),
+                                           self.config.get( 'queue_overflow', self.default_queue_overflow ) )
+        except ValueError:
+            raise TriggerException( 'invalid queue limits' )
+
     def check( self, element ):
         raise NotImplementedError
 
     def run( self, element ):
         raise NotImplementedError
 
+    def cancel( self ):
+        """
+        Release whatever the trigger holds outside of itself, such as timers.
+        """
+        pass
+
+    def getTemplateVariables( self ):
+        """
+        Return the names of the variables the trigger passes to its action on
+        top of the built-in ones, or None when they are only known at run time.
+        """
+        return set()
+
+    def process( self, element = None ):
+        """
+        The work item of the trigger queue: check the trigger and run its action
+        when the check succeeds.
+        """
+        def checkResponse( response ):
+            log.msg( 'checkResponse: %s' % self.name, level = logging.DEBUG )
+            if response:
+                return self.run( element )
+
+        return self.check( element ).addCallback( checkResponse )
+
 class ScheduledTrigger( Trigger ):
+    default_queue_overflow = 'coalesce'
 
     def __init__(self, handler, name, config):
         log.msg( 'ScheduledTrigger: init', level = logging.DEBUG )
@@ -169,38 +503,51 @@ class ScheduledTrigger( Trigger ):
             raise TriggerException( 'not schedule found' )
 
         try:
-            self.min, self.hour, self.day, self.month, self.year = config['schedule'].split(' ')
-        except:
-            raise TriggerException( 'invalid schedule' )
+            self.cron = CronSchedule( config['schedule'] )
+        except CronScheduleException, e:
+            raise TriggerException( str( e ) )
 
-    def check(self, element):
-        log.msg( 'ScheduledTrigger: check', level = logging.DEBUG )
-        if self.ran and not self.repeat:
-            return defer.succeed( False )
+        self.next_run = None
+        self.timer = None
 
-        my_now = datetime.now()
+    def schedule(self, after = None):
+        """
+        Put the next run of the trigger after the naive local datetime after,
+        or after now, on the handler scheduler.
+        """
+        now = datetime.fromtimestamp( self.handler.scheduler.seconds() )
+
+        if after is None or after < now:
+            after = now
 
-        year_match, mon_match, day_match, hour_match, min_match = [ True ] * 5
+        self.next_run = self.cron.nextTime( after )
 
-        if self.year and ( self.year != '*' and self.year != my_now.year ):
-            year_match = False
+        if self.next_run is None:
+            log.msg( 'ScheduledTrigger: %s will not run again' % self.name, level = logging.DEBUG )
+            return
 
-        if self.month and ( self.month != '*' and self.month != my_now.mon ):
-            mon_match = False
+        self.timer = self.handler.scheduler.callAt( CronSchedule.toTimestamp( self.next_run ), self.fire )
 
-        if self.day and ( self.day != '*' and self.day != my_now.day ):
-            day_match = False
+    def fire(self):
+        self.timer = None
+        self.queue.submit()
 
-        if self.hour and ( self.hour != '*' and self.hour != my_now.hour ):
-            hour_match = False
+        # continue from the minute that was due, so a minute repeated by a
+        # daylight saving change does not fire twice
+        if self.repeat:
+            self.schedule( self.next_run )
 
-        if self.min and ( self.min != '*' and self.min != my_now.min ):
-            min_match = False
+    def cancel(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
 
-        if [ year_match, mon_match, day_match, hour_match, min_match ] == [ True ] * 5:
-            return defer.succeed( True )
+    def check(self, element):
+        log.msg( 'ScheduledTrigger: check', level = logging.DEBUG )
+        if self.ran and not self.repeat:
+            return defer.succeed( False )
 
-        return defer.succeed( False )
+        return defer.succeed( True )
 
     def run( self, element ):
         log.msg( 'ScheduledTrigger: run', level = logging.DEBUG )
@@ -208,6 +555,7 @@ class ScheduledTrigger( Trigger ):
         return self.action.run()
 
 class TimedTrigger( Trigger ):
+    default_queue_overflow = 'coalesce'
 
     def __init__(self, hanler, name, config):
         log.msg( 'TimedTrigger: init', level = logging.DEBUG )
@@ -216,19 +564,56 @@ class TimedTrigger( Trigger ):
         if not 'delay' in config:
             raise TriggerException( 'not schedule found' )
 
+        try:
+            self.delay = float( config['delay'] )
+        except ValueError:
+            raise TriggerException( 'invalid delay' )
+
+        if self.delay <= 0:
+            raise TriggerException( 'invalid delay' )
+
         self.start = time.time()
         self.last_run = self.start
-        self.delay = float( config['delay'] )
+        self.next_run = None
+        self.timer = None
+
+    def schedule(self):
+        """
+        Put the first run of the trigger on the handler scheduler, delay
+        seconds from now.
+        """
+        self.next_run = self.handler.scheduler.seconds() + self.delay
+        self.timer = self.handler.scheduler.callAt( self.next_run, self.fire )
+
+    def fire(self):
+        self.timer = None
+        self.queue.submit()
+
+        if not self.repeat:
+            return
+
+        # the next run is based on when this one was due rather than on when it
+        # actually ran, so the trigger does not drift; runs missed while the
+        # reactor was busy are skipped instead of fired in a burst
+        now = self.handler.scheduler.seconds()
+        self.next_run += self.delay
+
+        if self.next_run <= now:
+            self.next_run += math.floor( ( now - self.next_run ) / self.delay + 1 ) * self.delay
+
+        self.timer = self.handler.scheduler.callAt( self.next_run, self.fire )
+
+    def cancel(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
 
     def check(self, element):
         log.msg( 'TimedTrigger: check', level = logging.DEBUG )
         if self.ran and not self.repeat:
             return defer.succeed( False )
 
-        if ( time.time() - self.last_run ) > self.delay:
-            return defer.succeed( True )
-
-        return defer.succeed( False )
+        return defer.succeed( True )
 
     def run( self, element ):
         log.msg( 'TimedTrigger: run', level = logging.DEBUG )
@@ -246,47 +631,315 @@ class EventTrigger( Trigger ):
         self.event_type = config['event_type']
         self.event = EVENT_TYPES[ self.event_type ]( config )
 
-    def check(self, element):
+    def check(self, element, from_jid = None):
+        """
+        Returns a deferred firing with a dict of the named groups matched by
+        the event content pattern, or None when the element does not match.
+        """
         log.msg( 'EventTrigger: check', level = logging.DEBUG )
         if self.ran and not self.repeat:
-            return defer.succeed( False )
+            return defer.succeed( None )
 
-        def matchElementResponse( response ):
-            log.msg( 'matchElementResponse', level = logging.DEBUG )
-            if not response:
-                return False
+        return self.event.matchElement( element, from_jid )
+
+    def process(self, element = None, from_jid = None, check_response = None):
+        """
+        Static event triggers are matched before being queued and pass their
+        check_response along; the others are checked here.
+        """
+        if self.ran and not self.repeat:
+            return
+
+        if check_response is not None:
+            return self.run( element, check_response )
+
+        def checkResponse( response ):
+            log.msg( 'checkResponse: %s' % self.name, level = logging.DEBUG )
+            if response is not None:
+                return self.run( element, response )
 
-            return response
+        return self.check( element, from_jid ).addCallback( checkResponse )
 
-        return self.event.matchElement( element ).addCallback( matchElementResponse )
+    def getTemplateVariables(self):
+        if not self.event.isStatic():
+            return None
+
+        if self.event.pattern is None:
+            return set()
+
+        return set( self.event.pattern.groupindex )
 
     def run(self, element, check_response ):
         log.msg( 'EventTrigger: run', level = logging.DEBUG )
         self.ran = True
         return self.action.run( triggering_element = element, check_response = check_response )
 
+class XPathTrigger( Trigger ):
+
+    def __init__(self, handler, name, config):
+        log.msg( 'XPathTrigger: init', level = logging.DEBUG )
+        Trigger.__init__(self, handler, name, config)
+
+        if not 'xpath' in config:
+            raise TriggerException( 'no xpath found' )
+
+        self.xpath = config['xpath'].strip()
+        self.root_expression = splitRootStep( self.xpath )
+
+        try:
+            self.query = xpath.internQuery( self.xpath )
+            xpath.internQuery( self.root_expression )
+        except SyntaxError:
+            raise TriggerException( 'invalid xpath' )
+
+    def check(self, element):
+        log.msg( 'XPathTrigger: check', level = logging.DEBUG )
+        if self.ran and not self.repeat:
+            return defer.succeed( None )
+
+        if not self.query.matches( element ):
+            return defer.succeed( None )
+
+        return defer.succeed( {} )
+
+    def process(self, element = None):
+        """
+        Elements are matched by the XPathTriggerGroup before being queued.
+        """
+        if self.ran and not self.repeat:
+            return
+
+        return self.run( element, {} )
+
+    def run(self, element, check_response ):
+        log.msg( 'XPathTrigger: run', level = logging.DEBUG )
+        self.ran = True
+        return self.action.run( triggering_element = element, check_response = check_response )
+
+class XPathTriggerGroup( object ):
+    """
+    The xpath triggers whose expressions share a first step. The xmlstream
+    observer for that step calls checkElement with the elements it matched, so
+    only the rest of each distinct expression is left to evaluate.
+    """
+
+    def __init__(self, root_expression):
+        self.root_expression = root_expression
+        self.expressions = {}
+
+    def __len__(self):
+        return sum( len( triggers ) for child_location, triggers in self.expressions.values() )
+
+    def addTrigger(self, trigger):
+        if not trigger.xpath in self.expressions:
+            child_location = None
+            if trigger.xpath != self.root_expression:
+                child_location = trigger.query.baseLocation.childLocation
+
+            self.expressions[ trigger.xpath ] = ( child_location, [] )
+
+        self.expressions[ trigger.xpath ][1].append( trigger )
+
+    def removeTrigger(self, trigger):
+        if not trigger.xpath in self.expressions:
+            return
+
+        triggers = self.expressions[ trigger.xpath ][1]
+        if trigger in triggers:
+            triggers.remove( trigger )
+
+        if not triggers:
+            del self.expressions[ trigger.xpath ]
+
+    def checkElement(self, element):
+        for child_location, triggers in self.expressions.values():
+            if child_location is not None and not any( child_location.matches( child ) for child in element.elements() ):
+                continue
+
+            for trigger in triggers:
+                if not trigger.ran or trigger.repeat:
+                    trigger.queue.submit( element )
+
+def splitRootStep( expression ):
+    """
+    Return the first location step of an absolute xpath expression, with its
+    predicates, e.g. "/message[@type='chat']" for "/message[@type='chat']/body".
+    Expressions starting with a descendant step are returned whole.
+    """
+    if not expression.startswith( '/' ) or expression.startswith( '//' ):
+        return expression
+
+    depth = 0
+    quote = None
+    for index in range( 1, len( expression ) ):
+        character = expression[ index ]
+
+        if quote:
+            if character == quote:
+                quote = None
+        elif character in '"\'':
+            quote = character
+        elif character == '[':
+            depth += 1
+        elif character == ']':
+            depth -= 1
+        elif character == '/' and not depth:
+            return expression[ :index ]
+
+    return expression
+
 class FilesystemTrigger( Trigger ):
-    filesystem_event_types = { 'create': pyinotify.IN_CREATE, 'delete': pyinotify.IN_DELETE, 'modify': pyinotify.IN_MODIFY, 'attrib': pyinotify.IN_ATTRIB }
+    """
+    Runs its action for filesystem events on path, or with
+    filesystem_recursive anywhere below it, on files whose names match one of
+    the comma separated filesystem_include globs, if any, and none of the
+    filesystem_exclude ones. With filesystem_debounce
+    set, the events of that many seconds following the first one are
+    collected into a single run; the action gets the number of events as
+    {count} and the affected file names, at most max_batch_files of them, as
+    {files}.
+    """
+    filesystem_event_types = { 'create': pyinotify.IN_CREATE,
+                               'delete': pyinotify.IN_DELETE,
+                               'modify': pyinotify.IN_MODIFY,
+                               'attrib': pyinotify.IN_ATTRIB,
+                               'close_write': pyinotify.IN_CLOSE_WRITE,
+                               'moved_from': pyinotify.IN_MOVED_FROM,
+                               'moved_to': pyinotify.IN_MOVED_TO,
+                               'delete_self': pyinotify.IN_DELETE_SELF,
+                             }
+    max_batch_files = 100
 
     def __init__(self, handler, name, config):
         Trigger.__init__(self, handler, name, config)
 
-        self.path = config['path']
+        self.path = os.path.normpath( config['path'] )
         self.last_run = 0
+        self.recursive = getBoolean( config, 'filesystem_recursive' )
+        self.include = compileGlobs( config.get( 'filesystem_include' ) )
+        self.exclude = compileGlobs( config.get( 'filesystem_exclude' ) )
+
+        try:
+            self.debounce = float( config.get( 'filesystem_debounce', 0 ) )
+        except ValueError:
+            raise TriggerException( 'invalid filesystem debounce' )
+
+        if self.debounce < 0:
+            raise TriggerException( 'invalid filesystem debounce' )
+
+        self.batch_files = collections.OrderedDict()
+        self.batch_count = 0
+        self.batch_timer = None
+
+        self.event_types = []
+        for etype in config.get( 'filesystem_event_types', 'create,delete,modify' ).split( ',' ):
+            etype = etype.strip()
+
+            if not etype in FilesystemTrigger.filesystem_event_types:
+                raise TriggerException( 'invalid filesystem event type %s' % etype )
+
+            if not FilesystemTrigger.filesystem_event_types[ etype ] in self.event_types:
+                self.event_types.append( FilesystemTrigger.filesystem_event_types[ etype ] )
 
-        #fs_event_types = config.get( 'filesystem_event_types', 'create,delete,modify' ).split(',')
-        self.event_types = list( FilesystemTrigger.filesystem_event_types[ etype ] for etype in EVENT_TYPES if etype in FilesystemTrigger.filesystem_event_types )
         self.mask = 0
         for et in self.event_types:
             self.mask = self.mask | et
 
-    def run(self, element):
+    def matchesName(self, name):
+        if self.include and not self.include.match( name ):
+            return False
+
+        return not ( self.exclude and self.exclude.match( name ) )
+
+    def notify(self, pathname):
+        """
+        Called by the inotify handler for each event on the file pathname.
+        """
+        self.batch_count += 1
+
+        if len( self.batch_files ) < self.max_batch_files:
+            self.batch_files[ pathname ] = None
+
+        if not self.debounce:
+            self.flush()
+        elif not self.batch_timer:
+            self.batch_timer = self.handler.scheduler.callLater( self.debounce, self.flush )
+
+    def flush(self):
+        self.batch_timer = None
+        batch = { 'count': self.batch_count, 'files': ', '.join( self.batch_files ) }
+
+        self.batch_files.clear()
+        self.batch_count = 0
+
+        self.queue.submit( None, batch )
+
+    def cancel(self):
+        if self.batch_timer:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+
+        self.batch_files.clear()
+        self.batch_count = 0
+
+    def getTemplateVariables(self):
+        return set( [ 'count', 'files' ] )
+
+    def process(self, element = None, batch = None):
+        if self.ran and not self.repeat:
+            return
+
+        return self.run( element, batch )
+
+    def run(self, element, batch):
         log.msg( 'FilesystemTrigger: run', level = logging.DEBUG )
         self.ran = True
         self.last_run = time.time()
-        return self.action.run()
+        return self.action.run( check_response = batch )
+
+def compileGlobs( globs ):
+    """
+    Compile a comma separated list of glob patterns to a single regular
+    expression matching any of them, or None for an empty list.
+    """
+    if not globs:
+        return None
+
+    patterns = [ fnmatch.translate( glob.strip() ) for glob in globs.split( ',' ) if glob.strip() ]
+
+    if not patterns:
+        return None
+
+    return re.compile( '|'.join( '(?:%s)' % pattern for pattern in patterns ) )
+
+def getFileStat( path ):
+    """
+    Return what tells whether path changed: its mtime and size, or None when
+    it cannot be stat()ed.
+    """
+    try:
+        stat = os.stat( path )
+    except OSError:
+        return None
+
+    return ( stat.st_mtime, stat.st_size )
+
+def getBoolean( config, option, default = False ):
+    """
+    Read a boolean option from a trigger config dict, the way ConfigParser's
+    getboolean would.
+    """
+    value = config.get( option )
+
+    if value is None:
+        return default
+
+    if not value.lower() in ConfigParser.RawConfigParser._boolean_states:
+        raise TriggerException( 'invalid boolean value for %s' % option )
+
+    return ConfigParser.RawConfigParser._boolean_states[ value.lower() ]
 
-TRIGGER_TYPES = { 'scheduled': ScheduledTrigger, 'timed': TimedTrigger, 'event': EventTrigger, 'filesystem': FilesystemTrigger, }
+TRIGGER_TYPES = { 'scheduled': ScheduledTrigger, 'timed': TimedTrigger, 'event': EventTrigger, 'xpath': XPathTrigger, 'filesystem': FilesystemTrigger, }
 
 class Action( object ):
 
@@ -297,11 +950,190 @@ class Action( object ):
         if not self.content_type in CONTENT_TYPES:
             raise TriggerException( 'Invalid content type.' )
 
-        self.content_handler = CONTENT_TYPES[ self.content_type ]( self.trigger.config['action_content_value'] )
+        self.content_handler = CONTENT_TYPES[ self.content_type ]( self.trigger.config['action_content_value'], getContentOptions( self.trigger.config, 'action_' ) )
+        self.template = None
+
+        # text content is a template unless content_template says otherwise;
+        # file and external content is sent as it is unless it says so
+        self.templated = getBoolean( self.content_handler.options, 'template', isinstance( self.content_handler, TextTriggerContent ) )
+
+        # text content never changes, so its template is compiled once here
+        if self.templated and isinstance( self.content_handler, TextTriggerContent ):
+            self.getTemplate( self.content_handler.value )
+
+    def validate(self):
+        """
+        Check that the static template only uses variables the trigger provides.
+        """
+        variables = self.trigger.getTemplateVariables()
+
+        if self.template is None or variables is None:
+            return
+
+        unknown = self.template.fields - variables - set( ActionVariables.names )
+
+        if unknown:
+            raise TriggerException( 'unknown action template variables: %s' % ', '.join( sorted( unknown ) ) )
+
+    def getTemplate(self, text):
+        """
+        Return the compiled template for text, only recompiling when the text
+        differs from the last one seen.
+        """
+        if self.template is None or self.template.text != text:
+            self.template = ActionTemplate( text )
+
+        return self.template
+
+    def render(self, text, element = None, check_response = None):
+        """
+        Fill the template of text with the variables it uses; variables not
+        known when it runs are left empty. Content that is not a template, or
+        fails to render, is returned as it is.
+        """
+        if not self.templated:
+            return text
+
+        try:
+            return self.renderTemplate( text, element, check_response )
+        except ( TriggerException, ValueError, KeyError, IndexError, AttributeError, TypeError ), e:
+            log.msg( 'Action %s: unable to render content, sending it as it is: %s' % ( self.trigger.name, e ) )
+            return text
+
+    def renderTemplate(self, text, element, check_response):
+        template = self.getTemplate( text )
+
+        if not template.fields:
+            return template.render( {} )
+
+        check_response = check_response or {}
+        variables = ActionVariables( self.trigger, element )
+        values = {}
+
+        for name in template.fields:
+            if name in check_response:
+                values[ name ] = check_response[ name ]
+            elif name in ActionVariables.names:
+                values[ name ] = variables.get( name )
+            else:
+                log.msg( 'Action %s: no value for {%s}' % ( self.trigger.name, name ), level = logging.DEBUG )
+                values[ name ] = ''
+
+        return template.render( values )
 
     def run(self, *args, **kwargs):
         raise NotImplementedError
 
+class ActionTemplate( object ):
+    """
+    Action content in str.format syntax, parsed once. fields holds the names
+    of the variables it uses, so only those have to be looked up.
+    """
+    formatter = string.Formatter()
+
+    def __init__(self, text):
+        self.text = text
+        self.fields = set()
+
+        try:
+            self.parts = list( self.formatter.parse( text ) )
+        except ValueError:
+            raise TriggerException( 'invalid action template' )
+
+        for literal, field, format_spec, conversion in self.parts:
+            if field is None:
+                continue
+
+            name = re.match( r'[^.[]*', field ).group()
+
+            # variables are plain values, so attribute and index access could
+            # only fail when the action runs
+            if not name or name.isdigit() or name != field or '{' in format_spec or not conversion in ( None, 'r', 's' ):
+                raise TriggerException( 'unsupported action template field {%s}' % field )
+
+            self.fields.add( name )
+
+    def render(self, values):
+        output = []
+
+        for literal, field, format_spec, conversion in self.parts:
+            output.append( literal )
+
+            if field is None:
+                continue
+
+            value = self.formatter.get_field( field, (), values )[0]
+            value = self.formatter.convert_field( value, conversion )
+            output.append( self.formatter.format_field( value, format_spec ) )
+
+        return ''.join( output )
+
+class ActionVariables( object ):
+    """
+    The built-in variables of action templates, each worked out only when a
+    template asks for it. Variables that do not apply, such as the sender of
+    a scheduled trigger, are empty.
+    """
+    names = [ 'sender', 'sender_bare', 'sender_user', 'sender_host', 'sender_resource', 'room', 'nick', 'my_jid', 'timestamp', 'trigger', 'path' ]
+
+    def __init__(self, trigger, element = None):
+        self.trigger = trigger
+        self.element = element
+        self.sender_jid = None
+
+    def get(self, name):
+        return getattr( self, 'get' + name.title().replace( '_', '' ) )()
+
+    def getSenderJid(self):
+        if self.sender_jid is None and self.element is not None and self.element.hasAttribute( 'from' ):
+            try:
+                self.sender_jid = jid.JID( self.element['from'] )
+            except jid.InvalidFormat:
+                pass
+
+        return self.sender_jid
+
+    def getSender(self):
+        sender_jid = self.getSenderJid()
+        return sender_jid and sender_jid.full() or ''
+
+    def getSenderBare(self):
+        sender_jid = self.getSenderJid()
+        return sender_jid and sender_jid.userhost() or ''
+
+    def getSenderUser(self):
+        sender_jid = self.getSenderJid()
+        return sender_jid and sender_jid.user or ''
+
+    def getSenderHost(self):
+        sender_jid = self.getSenderJid()
+        return sender_jid and sender_jid.host or ''
+
+    def getSenderResource(self):
+        sender_jid = self.getSenderJid()
+        return sender_jid and sender_jid.resource or ''
+
+    def isGroupchat(self):
+        return self.element is not None and self.element.getAttribute( 'type' ) == 'groupchat'
+
+    def getRoom(self):
+        return self.isGroupchat() and self.getSenderBare() or ''
+
+    def getNick(self):
+        return self.isGroupchat() and self.getSenderResource() or ''
+
+    def getMyJid(self):
+        return self.trigger.handler.my_client.jid.full()
+
+    def getTimestamp(self):
+        return time.strftime( '%Y-%m-%d %H:%M:%S' )
+
+    def getTrigger(self):
+        return self.trigger.name
+
+    def getPath(self):
+        return getattr( self.trigger, 'path', '' )
+
 class MessageActionExceptionNoTriggeringElement( Exception ):
     pass
 
@@ -312,13 +1144,27 @@ class MessageAction( Action ):
 
         self.recipient = self.trigger.config['action_recipient']
         self.message_type = self.trigger.config['action_message_type']
+        self.priority = self.trigger.config.get( 'action_priority', 'normal' )
+
+        if not self.priority in SendQueue.priorities:
+            raise TriggerException( 'invalid action priority' )
+
+        # messages to a fixed recipient are spliced into a serialized template
+        self.recipient_jid = None
+        self.stanza_template = None
+
+        if self.recipient != "##event_source##":
+            try:
+                self.recipient_jid = jid.JID( self.recipient )
+            except jid.InvalidFormat:
+                raise TriggerException( 'invalid action recipient' )
+
+            self.stanza_template = StanzaTemplate( self.recipient_jid, self.message_type )
 
     def run(self, *args, **kwargs):
         log.msg( 'MessageAction: run', level = logging.DEBUG )
 
         if self.recipient == "##event_source##":
-            print kwargs.keys()
-
             if not 'triggering_element' in kwargs:
                 raise MessageActionExceptionNoTriggeringElement()
 
@@ -327,39 +1173,125 @@ class MessageAction( Action ):
 
             my_recipient_jid = jid.JID( triggering_element[ 'from' ] )
         else:
-            my_recipient_jid = jid.JID( self.recipient )
+            my_recipient_jid = self.recipient_jid
 
         if self.message_type == "groupchat":
             log.msg( 'MessageAction Type: groupchat')
             muc_client = CommonClientManager.getHandler( 'muc', self.trigger.handler.my_client )
 
-            if not muc_client._getRoom( my_recipient_jid ):
+            if not muc_client.isInRoom( my_recipient_jid ):
                 log.msg( 'not in room', level = logging.DEBUG )
                 return False
 
         def getContentResponse( response ):
             log.msg( 'MessageAction: getContentResponse', level = logging.DEBUG )
-            msg = domish.Element( (None, 'message') )
-            msg['type'] = self.message_type
-            msg['to'] = my_recipient_jid.full()
 
-            processed_response = response
-            if 'check_response' in kwargs:
-                print kwargs['check_response']
-                processed_response = response.format( **kwargs[ 'check_response' ].groupdict() )
+            processed_response = self.render( response, kwargs.get( 'triggering_element' ), kwargs.get( 'check_response' ) )
 
             log.msg( 'processed_response: %s' % processed_response )
-            msg.addElement('body', None, processed_response )
-            self.trigger.handler.xmlstream.send( msg )
+            self.trigger.handler.coalescer.send( my_recipient_jid, self.message_type, processed_response, self.priority, self.stanza_template )
 
-        self.content_handler.getContent().addCallback( getContentResponse )
+        return self.content_handler.getContent().addCallback( getContentResponse )
 
 ACTION_TYPES = { 'message': MessageAction }
 
+class MessageCoalescer( object ):
+    """
+    Builds the messages of message actions and hands them to the send queue.
+
+    With a window set, the bodies of messages of the same type sent to the
+    same recipient within window seconds of the first one are joined with
+    separator into a single message, which takes the highest of their
+    priorities. A body that would take the joined one past max_size characters
+    sends what was collected so far first.
+    """
+
+    def __init__(self, scheduler, send_queue, window = 0, separator = '\n', max_size = 4096):
+        self.scheduler = scheduler
+        self.send_queue = send_queue
+        self.window = window
+        self.separator = separator
+        self.max_size = max_size
+
+        # ( recipient, message type ) -> [ bodies, size, priority, timer, template ]
+        self.pending = {}
+
+    def send(self, recipient_jid, message_type, body, priority = 'normal', template = None):
+        if not self.window:
+            self.sendMessage( recipient_jid, message_type, body, priority, template )
+            return
+
+        key = ( recipient_jid.full(), message_type )
+
+        if key in self.pending and self.pending[ key ][1] + len( self.separator ) + len( body ) > self.max_size:
+            self.flush( key )
+
+        if not key in self.pending:
+            timer = self.scheduler.callLater( self.window, self.flush, key )
+            self.pending[ key ] = [ [], -len( self.separator ), priority, timer, template ]
+
+        batch = self.pending[ key ]
+        batch[0].append( body )
+        batch[1] += len( self.separator ) + len( body )
+
+        if SendQueue.priorities.index( priority ) < SendQueue.priorities.index( batch[2] ):
+            batch[2] = priority
+
+    def flush(self, key):
+        bodies, size, priority, timer, template = self.pending.pop( key )
+
+        if timer.active():
+            timer.cancel()
+
+        if len( bodies ) > 1:
+            log.msg( 'MessageCoalescer: joined %d messages to %s' % ( len( bodies ), key[0] ), level = logging.DEBUG )
+
+        self.sendMessage( jid.JID( key[0] ), key[1], self.separator.join( bodies ), priority, template )
+
+    def sendMessage(self, recipient_jid, message_type, body, priority, template = None):
+        if template:
+            msg = template.render( body )
+        else:
+            msg = domish.Element( (None, 'message') )
+            msg['type'] = message_type
+            msg['to'] = recipient_jid.full()
+            msg.addUniqueId()
+            msg.addElement('body', None, body )
+
+        self.send_queue.send( msg, recipient_jid.userhost(), message_type == 'groupchat', priority )
+
+class StanzaTemplate( object ):
+    """
+    A message to a fixed recipient, serialized once around the places of its
+    id and body, so sending it only escapes the body and splices it in
+    instead of building and serializing a domish tree. Ids come from the same
+    counter as domish's addUniqueId.
+    """
+
+    def __init__(self, recipient_jid, message_type):
+        self.prefix = u"<message type='%s' to='%s' id='" % ( domish.escapeToXml( message_type, 1 ), domish.escapeToXml( recipient_jid.full(), 1 ) )
+        self.infix = u"'><body>"
+        self.suffix = u"</body></message>"
+
+    def render(self, body):
+        stanza_id = 'H_%d' % domish.Element._idCounter
+        domish.Element._idCounter += 1
+
+        return u''.join( ( self.prefix, stanza_id, self.infix, domish.escapeToXml( body ), self.suffix ) )
+
+def getContentOptions( config, prefix = '' ):
+    """
+    Return the options of config named prefix + 'content_<option>', keyed by
+    <option>.
+    """
+    prefix = prefix + 'content_'
+    return dict( ( key[ len( prefix ): ], value ) for key, value in config.items() if key.startswith( prefix ) )
+
 class TriggerContent( object ):
 
-    def __init__(self, value):
+    def __init__(self, value, options = None):
         self.value = value
+        self.options = options or {}
 
     def getContent(self):
         """
@@ -377,25 +1309,175 @@ class TextTriggerContent( TriggerContent ):
     def getContent(self):
         return defer.succeed( self.value )
 
+class FileContentCacheEntry( object ):
+
+    def __init__(self, content, mtime, size, checked):
+        self.content = content
+        self.mtime = mtime
+        self.size = size
+        self.checked = checked
+
+class FileContentCache( object ):
+    """
+    Caches file contents by path, bounded to max_bytes of content with the least
+    recently used files evicted first.
+
+    A cached file is served from memory for revalidate_interval seconds after it
+    was last checked. After that it is stat()ed again and only reread when its
+    mtime or size changed. Every stat and read happens off the reactor thread,
+    and concurrent requests for the same path wait on a single one.
+    """
+    unchanged = object()
+
+    def __init__(self, max_bytes = 4 * 1024 * 1024, revalidate_interval = 1.0, clock = reactor):
+        self.max_bytes = max_bytes
+        self.revalidate_interval = revalidate_interval
+        self.clock = clock
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.pending = {}
+
+    def getContent(self, path):
+        """
+        Returns a deferred firing with the content of path, or None when it
+        cannot be read.
+        """
+        entry = self.entries.get( path )
+
+        if entry and self.clock.seconds() - entry.checked < self.revalidate_interval:
+            # move it to the most recently used end
+            del self.entries[ path ]
+            self.entries[ path ] = entry
+            return defer.succeed( entry.content )
+
+        d = defer.Deferred()
+
+        if path in self.pending:
+            self.pending[ path ].append( d )
+            return d
+
+        self.pending[ path ] = [ d ]
+
+        known = None
+        if entry:
+            known = ( entry.mtime, entry.size )
+
+        threads.deferToThread( self.readFile, path, known ).addBoth( self.readFileResponse, path )
+        return d
+
+    def readFile(self, path, known):
+        """
+        Runs in a reactor pool thread.
+        """
+        try:
+            stat = os.stat( path )
+        except OSError:
+            return None
+
+        if known == ( stat.st_mtime, stat.st_size ):
+            return self.unchanged
+
+        try:
+            fd = open( path )
+            try:
+                content = fd.read()
+            finally:
+                fd.close()
+        except IOError:
+            return None
+
+        return ( content, stat.st_mtime, stat.st_size )
+
+    def readFileResponse(self, response, path):
+        waiting = self.pending.pop( path, [] )
+
+        if isinstance( response, failure.Failure ):
+            log.err( response )
+            response = None
+
+        if response is self.unchanged:
+            entry = self.entries.pop( path, None )
+
+            if entry is None:
+                # evicted while it was being checked, so read it again
+                for d in waiting:
+                    self.getContent( path ).chainDeferred( d )
+                return
+
+            entry.checked = self.clock.seconds()
+            self.entries[ path ] = entry
+            content = entry.content
+        else:
+            self.invalidate( path )
+            content = None
+
+            if response is not None:
+                content, mtime, size = response
+                self.store( path, FileContentCacheEntry( content, mtime, size, self.clock.seconds() ) )
+
+        for d in waiting:
+            d.callback( content )
+
+    def store(self, path, entry):
+        if len( entry.content ) > self.max_bytes:
+            return
+
+        self.entries[ path ] = entry
+        self.size += len( entry.content )
+
+        while self.size > self.max_bytes:
+            evicted_path, evicted = self.entries.popitem( last = False )
+            self.size -= len( evicted.content )
+            log.msg( 'FileContentCache: evicted %s' % evicted_path, level = logging.DEBUG )
+
+    def invalidate(self, path):
+        entry = self.entries.pop( path, None )
+
+        if entry:
+            self.size -= len( entry.content )
+
 class FileTriggerContent( TriggerContent ):
+    cache = FileContentCache()
 
     def getContent(self):
-        if not os.path.exists( self.value ) or not os.access( self.value, os.R_OK ):
-            return 'file not found'
 
-        fd = open( self.value )
-        fd_raw = fd.read()
-        fd.close()
+        def getFileContentResponse( response ):
+            if response is None:
+                return 'file not found'
 
-        return defer.succeed( str( fd_raw ) )
+            return str( response )
 
-class ExternalTriggerContent( TriggerContent ):
+        return self.cache.getContent( self.value ).addCallback( getFileContentResponse )
 
-    def __init__(self, value, timeout = 300 ):
-        TriggerContent.__init__(self, value)
+class ExternalTriggerContent( TriggerContent ):
+    """
+    The output of an external command.
+
+    With content_coalesce a request made while the same command line is already
+    running waits for that run instead of starting another process. With
+    content_cache_ttl the output of a successful run is also reused for that
+    many seconds; the cache is shared by every trigger running the same command
+    line, each applying its own ttl.
+    """
+    executor = ProcessExecutor()
+    in_flight = {}
+    results = {}
+
+    def __init__(self, value, options = None ):
+        TriggerContent.__init__(self, value, options)
 
         self.exec_path = value.split()
-        self.timeout = timeout
+
+        try:
+            self.timeout = float( self.options.get( 'timeout', 300 ) )
+            self.max_output = int( self.options.get( 'max_output', 65536 ) )
+            self.cache_ttl = float( self.options.get( 'cache_ttl', 0 ) )
+        except ValueError:
+            raise TriggerException( 'invalid external content limits' )
+
+        self.coalesce = getBoolean( self.options, 'coalesce', self.cache_ttl > 0 )
+
+        self.command = ' '.join( self.exec_path )
 
         log.msg( 'ExternalTriggerContent self.exec_path %s' % self.exec_path, level = logging.DEBUG )
 
@@ -403,17 +1485,56 @@ class ExternalTriggerContent( TriggerContent ):
         if not os.path.exists( self.exec_path[0] ) or not os.access( self.exec_path[0], os.X_OK ):
             return defer.succeed( 'command not accessible' )
 
-        proc = subprocess.Popen( [ '/bin/sh', '-c', ' '.join( self.exec_path ) ], stdout = subprocess.PIPE, stderr = subprocess.PIPE )
+        if self.cache_ttl:
+            cached = self.results.get( self.command )
+            if cached and reactor.seconds() - cached[0] < self.cache_ttl:
+                log.msg( 'ExternalTriggerContent: cached %s' % self.value, level = logging.DEBUG )
+                return defer.succeed( cached[1] )
+
+        if self.coalesce and self.command in self.in_flight:
+            log.msg( 'ExternalTriggerContent: joining running %s' % self.value, level = logging.DEBUG )
+            d = defer.Deferred()
+            self.in_flight[ self.command ].append( d )
+            return d
 
         def getExternalContentCallback( response ):
             log.msg( 'getExternalContentCallback', level = logging.DEBUG )
-            if response:
+            if response.timed_out:
+                log.err( 'External process timed out after %s seconds: %s' % ( self.timeout, self.value ) )
+            elif response.exit_code:
                 log.err( 'External process returned abnormally' )
-                log.err( proc.stderr.read() )
+                log.err( response.stderr )
+
+            if response.truncated:
+                log.msg( 'External process output truncated to %d bytes' % self.max_output, level = logging.DEBUG )
+
+            content = str( response.stdout )
 
-            return str( proc.stdout.read() )
+            if response.succeeded():
+                self.results[ self.command ] = ( reactor.seconds(), content )
 
-        return threads.deferToThread( proc.wait ).addCallback( getExternalContentCallback ).addErrback( log.err )
+            return content
+
+        def getExternalContentErrback( reason ):
+            log.err( reason )
+            return 'command failed'
+
+        def notifyWaiting( content ):
+            for d in self.in_flight.pop( self.command, [] ):
+                d.callback( content )
+
+            return content
+
+        owner = not self.command in self.in_flight
+        if owner:
+            self.in_flight[ self.command ] = []
+
+        d = self.executor.execute( [ '/bin/sh', '-c', self.command ], self.timeout, self.max_output ).addCallbacks( getExternalContentCallback, getExternalContentErrback )
+
+        if owner:
+            d.addCallback( notifyWaiting )
+
+        return d
 
 CONTENT_TYPES = { 'text': TextTriggerContent, 'file': FileTriggerContent, 'external': ExternalTriggerContent, }
 
@@ -421,22 +1542,16 @@ class EventType( object ):
 
     def __init__(self, config):
         self.type = config['event_type']
-        self.value = config['content_value']
+        self.value = config.get( 'content_value', '' )
 
         if not self.type in EVENT_TYPES:
             raise TriggerException( 'invalid event type' )
 
-    def matchElement(self, element):
-        raise NotImplementedError
-
-class MessageEventType( EventType ):
-
-    def __init__(self, config):
-        super( MessageEventType, self ).__init__( config )
-
         self.source_entity = jid.JID( config['event_source'] )
         self.content_type = False
         self.content_handler = False
+        self.pattern = None
+        self.pattern_source = None
 
         if 'content_type' in config:
             self.content_type = config['content_type']
@@ -444,91 +1559,295 @@ class MessageEventType( EventType ):
             if not self.content_type in CONTENT_TYPES:
                 raise TriggerException( 'Invalid content type.' )
 
-            self.content_handler = CONTENT_TYPES[ self.content_type ]( self.value )
+            self.content_handler = CONTENT_TYPES[ self.content_type ]( self.value, getContentOptions( config ) )
 
-    def matchElement(self, element):
-        log.msg( 'matchElement', level = logging.DEBUG )
-        log.msg( 'name: %s' % element.name, level = logging.DEBUG )
-        log.msg( 'type: %s' % self.type, level = logging.DEBUG )
-        log.msg( 'from: %s' % element['from'], level = logging.DEBUG )
-        log.msg( 'source: %s' % self.source_entity, level = logging.DEBUG )
+            # text patterns never change, so they are compiled once here
+            if self.isStatic():
+                try:
+                    self.getPattern( self.value )
+                except re.error:
+                    raise TriggerException( 'invalid content pattern' )
 
-        from_jid = jid.JID( element['from'] )
+    @staticmethod
+    def getSourceKeys( from_jid ):
+        """
+        Return the source entity strings that a stanza from from_jid can match,
+        in the order used to look them up in TriggerHandler.event_index.
+        """
+        raise NotImplementedError
 
-        if not self.source_entity == from_jid and not self.source_entity == from_jid.userhostJID() and not self.source_entity.full() == from_jid.host:
-            return defer.succeed( False )
+    @staticmethod
+    def getSubject( element ):
+        """
+        Return the string of element that content patterns are matched against.
+        """
+        raise NotImplementedError
+
+    def isStatic(self):
+        """
+        A static event type can be matched without fetching its content.
+        """
+        return not self.content_handler or self.content_type == 'text'
+
+    def getPattern(self, pattern_source):
+        """
+        Return the compiled pattern for pattern_source, only recompiling when
+        the source differs from the last one seen.
+        """
+        if self.pattern is None or pattern_source != self.pattern_source:
+            self.pattern = re.compile( pattern_source )
+            self.pattern_source = pattern_source
+
+        return self.pattern
+
+    def matchSubject(self, subject):
+        """
+        Returns a deferred firing with the named groups of the content pattern
+        matched against subject, or None when it does not match.
+        """
+        if not self.content_handler:
+            return defer.succeed( {} )
+
+        if subject is None:
+            return defer.succeed( None )
 
         def getContentResponse( response ):
             log.msg( 'getContentResponse', level = logging.DEBUG )
             log.msg( 'response: %s' % response, level = logging.DEBUG )
-            log.msg( 'body: %s' % element.body, level = logging.DEBUG )
-            response_match = re.match( response, str( element.body ) )
+            log.msg( 'subject: %s' % subject, level = logging.DEBUG )
+
+            try:
+                response_match = self.getPattern( response ).match( subject )
+            except re.error:
+                log.err( 'Invalid content pattern: %s' % response )
+                return None
+
             if response_match:
                 log.msg( 'matched', level = logging.DEBUG )
-                return response_match
+                return response_match.groupdict()
 
-            return False
+            return None
 
-        if self.content_handler:
-            return self.content_handler.getContent().addCallback( getContentResponse )
+        if self.isStatic():
+            return defer.succeed( getContentResponse( self.pattern_source ) )
 
-        return defer.succeed( True )
+        return self.content_handler.getContent().addCallback( getContentResponse )
 
-class PresenceEventType( EventType ):
+    def matchElement(self, element, from_jid = None):
+        raise NotImplementedError
 
-    def __init__(self, config):
-        super( PresenceEventType, self ).__init__( config )
+def uniqueSourceKeys( *keys ):
+    unique_keys = []
+    for key in keys:
+        if key and not key in unique_keys:
+            unique_keys.append( key )
 
-        self.source_entity = jid.JID( config['event_source'] )
-        self.content_type = False
-        self.content_handler = False
+    return unique_keys
 
-        if 'content_type' in config:
-            self.content_type = config['content_type']
+class MessageEventType( EventType ):
 
-            if not self.content_type in CONTENT_TYPES:
-                raise TriggerException( 'Invalid content type.' )
+    @staticmethod
+    def getSourceKeys( from_jid ):
+        return uniqueSourceKeys( from_jid.full(), from_jid.userhost(), from_jid.host )
+
+    @staticmethod
+    def getSubject( element ):
+        if element.body is None:
+            return None
+
+        return unicode( element.body )
+
+    def matchElement(self, element, from_jid = None):
+        log.msg( 'matchElement', level = logging.DEBUG )
+        log.msg( 'name: %s' % element.name, level = logging.DEBUG )
+        log.msg( 'type: %s' % self.type, level = logging.DEBUG )
+        log.msg( 'from: %s' % element['from'], level = logging.DEBUG )
+        log.msg( 'source: %s' % self.source_entity, level = logging.DEBUG )
+
+        if from_jid is None:
+            from_jid = jid.JID( element['from'] )
+
+        if not self.source_entity == from_jid and not self.source_entity == from_jid.userhostJID() and not self.source_entity.full() == from_jid.host:
+            return defer.succeed( None )
 
-            self.content_handler = CONTENT_TYPES[ self.content_type ]( self.value )
+        return self.matchSubject( self.getSubject( element ) )
 
-    def matchElement(self, element):
+class PresenceEventType( EventType ):
+
+    @staticmethod
+    def getSourceKeys( from_jid ):
+        return uniqueSourceKeys( from_jid.full(), from_jid.userhost() )
+
+    @staticmethod
+    def getSubject( element ):
+        # validate presece message type
+        return element.getAttribute( 'type', 'available' )
+
+    def matchElement(self, element, from_jid = None):
         log.msg( 'PresenceEventType matchElement', level = logging.DEBUG )
         log.msg( 'name: %s' % element.name, level = logging.DEBUG )
         log.msg( 'type: %s' % self.type, level = logging.DEBUG )
         if element.name != self.type:
-            return defer.succeed( False )
+            return defer.succeed( None )
 
         # validate presence message source
         log.msg( 'from: %s' % element['from'], level = logging.DEBUG )
         log.msg( 'source: %s' % self.source_entity, level = logging.DEBUG )
 
-        from_jid = jid.JID( element['from'] )
+        if from_jid is None:
+            from_jid = jid.JID( element['from'] )
 
         if not self.source_entity == from_jid and not self.source_entity == from_jid.userhostJID():
-            return defer.succeed( False )
+            return defer.succeed( None )
 
-        # validate presece message type
-        if 'type' in element.attributes:
-            presence_type = element['type']
-        else:
-            presence_type = 'available'
+        return self.matchSubject( self.getSubject( element ) )
 
-        def getContentResponse( response ):
-            log.msg( 'getContentResponse', level = logging.DEBUG )
-            log.msg( 'response: %s' % response, level = logging.DEBUG )
-            log.msg( 'type: %s' % presence_type, level = logging.DEBUG )
-            response_match = re.match( response, presence_type )
-            if response_match:
-                log.msg( 'matched', level = logging.DEBUG )
-                return response_match
+EVENT_TYPES = { 'message': MessageEventType, 'presence': PresenceEventType }
 
-            return False
+class MultiPatternMatcher( object ):
+    """
+    Matches a subject against many compiled patterns in as few passes as possible.
+
+    Patterns are joined into alternations with each pattern wrapped in a group
+    named after its position, and its own named groups prefixed so they cannot
+    collide. A subject matching none of the patterns of an alternation is
+    rejected by that single regex; on a hit the wrapping group tells the first
+    pattern that matched and only the patterns after it are tried individually.
+    Alternations are split into chunks to stay below the group limit of the re
+    module. Patterns that cannot safely be combined (inline flags, numbered
+    backreferences) are always tried individually.
+    """
+    max_groups = 99
+    group_name_re = re.compile( r'(?<!\\)\(\?P([<=])(\w+)' )
+    uncombinable_re = re.compile( r'(?<!\\)(\(\?[iLmsux]+\)|\\[1-9])' )
+
+    def __init__(self):
+        self.patterns = []
+        self.chunks = []
+        self.compiled = True
+
+    def __len__(self):
+        return len( self.patterns )
+
+    def addPattern(self, key, pattern):
+        self.patterns.append( ( key, pattern ) )
+        self.compiled = False
+
+    def removePattern(self, key):
+        self.patterns = [ ( k, p ) for k, p in self.patterns if k is not key ]
+        self.compiled = False
+
+    def compile(self):
+        self.chunks = []
+
+        chunk = []
+        chunk_groups = 0
+        for key, pattern in self.patterns:
+            if self.uncombinable_re.search( pattern.pattern ) or pattern.groups + 1 > self.max_groups:
+                self.chunks.append( ( None, [ ( key, pattern ) ], [] ) )
+                continue
 
-        if self.content_handler:
-            return self.content_handler.getContent().addCallback( getContentResponse )
+            if chunk_groups + pattern.groups + 1 > self.max_groups:
+                self.chunks.append( self.compileChunk( chunk ) )
+                chunk = []
+                chunk_groups = 0
 
-        return defer.succeed( True )
+            chunk.append( ( key, pattern ) )
+            chunk_groups += pattern.groups + 1
 
-EVENT_TYPES = { 'message': MessageEventType, 'presence': PresenceEventType }
+        if chunk:
+            self.chunks.append( self.compileChunk( chunk ) )
+
+        self.compiled = True
+
+    def compileChunk(self, chunk):
+        parts = []
+        group_names = []
+        for index, ( key, pattern ) in enumerate( chunk ):
+            prefix = '_%d_' % index
+
+            def prefixName( match ):
+                return '(?P%s%s%s' % ( match.group( 1 ), prefix, match.group( 2 ) )
+
+            parts.append( '(?P<_%d>%s)' % ( index, self.group_name_re.sub( prefixName, pattern.pattern ) ) )
+            group_names.append( dict( ( prefix + name, name ) for name in pattern.groupindex ) )
+
+        try:
+            return ( re.compile( '|'.join( parts ) ), chunk, group_names )
+        except ( re.error, AssertionError, OverflowError ):
+            log.msg( 'MultiPatternMatcher: patterns not combinable', level = logging.DEBUG )
+            return ( None, chunk, [] )
+
+    def match(self, subject):
+        """
+        Return a list of ( key, named groups ) for every pattern matching subject.
+        """
+        if not self.compiled:
+            self.compile()
+
+        results = []
+        for combined, chunk, group_names in self.chunks:
+            index = 0
+
+            if combined is not None:
+                combined_match = combined.match( subject )
+                if not combined_match:
+                    continue
+
+                index = int( combined_match.lastgroup[1:] )
+                groups = dict( ( name, combined_match.group( prefixed ) ) for prefixed, name in group_names[ index ].items() )
+                results.append( ( chunk[ index ][0], groups ) )
+                index += 1
+
+            for key, pattern in chunk[ index: ]:
+                pattern_match = pattern.match( subject )
+                if pattern_match:
+                    results.append( ( key, pattern_match.groupdict() ) )
+
+        return results
+
+class EventTriggerGroup( object ):
+    """
+    The event triggers of one event type that share a source entity. Triggers
+    with a static content pattern are matched together by a MultiPatternMatcher,
+    triggers without content always match and the rest are checked one by one.
+    """
+
+    def __init__(self, event_type):
+        self.event_type = event_type
+        self.matcher = MultiPatternMatcher()
+        self.unconditional_triggers = []
+        self.dynamic_triggers = []
+
+    def __len__(self):
+        return len( self.matcher ) + len( self.unconditional_triggers ) + len( self.dynamic_triggers )
+
+    def addTrigger(self, trigger):
+        if not trigger.event.isStatic():
+            self.dynamic_triggers.append( trigger )
+        elif trigger.event.pattern is None:
+            self.unconditional_triggers.append( trigger )
+        else:
+            self.matcher.addPattern( trigger, trigger.event.pattern )
+
+    def removeTrigger(self, trigger):
+        if trigger in self.dynamic_triggers:
+            self.dynamic_triggers.remove( trigger )
+        elif trigger in self.unconditional_triggers:
+            self.unconditional_triggers.remove( trigger )
+        else:
+            self.matcher.removePattern( trigger )
+
+    def matchSubject(self, subject):
+        """
+        Return a list of ( trigger, named groups ) for the static triggers
+        matching subject.
+        """
+        results = [ ( trigger, {} ) for trigger in self.unconditional_triggers ]
+
+        if subject is not None and len( self.matcher ):
+            results.extend( self.matcher.match( subject ) )
+
+        return results
 
 CommonClientManager.addHandler( 'trigger', TriggerHandler )
@@ -0,0 +1,102 @@
+from datetime import datetime
+import os, time, unittest
+
+from common.cron_schedule import CronSchedule
+
+# a zone with daylight saving time; 2026 springs forward on March 8 and falls
+# back on November 1, both at 2:00
+TEST_TZ = 'America/New_York'
+
+saved_tz = None
+
+def setUpModule():
+    global saved_tz
+    saved_tz = os.environ.get( 'TZ' )
+    os.environ[ 'TZ' ] = TEST_TZ
+    time.tzset()
+
+def tearDownModule():
+    if saved_tz is None:
+        del os.environ[ 'TZ' ]
+    else:
+        os.environ[ 'TZ' ] = saved_tz
+
+    time.tzset()
+
+class MonthEndTest( unittest.TestCase ):
+
+    def test31stSkipsShortMonths( self ):
+        schedule = CronSchedule( '0 12 31 * *' )
+        when = datetime( 2026, 1, 31, 12, 0 )
+        fired = []
+
+        for i in range( 6 ):
+            when = schedule.nextTime( when )
+            fired.append( when )
+
+        self.assertEqual( fired, [ datetime( 2026, month, 31, 12, 0 ) for month in [ 3, 5, 7, 8, 10, 12 ] ] )
+
+    def testLastMinuteOfMonthRollsOver( self ):
+        schedule = CronSchedule( '* * * * *' )
+        self.assertEqual( schedule.nextTime( datetime( 2026, 4, 30, 23, 59, 30 ) ), datetime( 2026, 5, 1, 0, 0 ) )
+        self.assertEqual( schedule.nextTime( datetime( 2026, 12, 31, 23, 59 ) ), datetime( 2027, 1, 1, 0, 0 ) )
+
+    def testFeb29OnlyInLeapYears( self ):
+        schedule = CronSchedule( '0 0 29 2 *' )
+        self.assertEqual( schedule.nextTime( datetime( 2026, 1, 1 ) ), datetime( 2028, 2, 29 ) )
+        self.assertEqual( schedule.nextTime( datetime( 2028, 2, 29 ) ), datetime( 2032, 2, 29 ) )
+
+    def testFeb29NeverInNonLeapYear( self ):
+        self.assertEqual( CronSchedule( '0 0 29 2 2027' ).nextTime( datetime( 2026, 1, 1 ) ), None )
+
+    def testFeb29OrWeekday( self ):
+        # a restricted day and weekday match either, as with cron; no monday
+        # is left in february 2026
+        schedule = CronSchedule( '0 0 29 2 * mon' )
+        self.assertEqual( schedule.nextTime( datetime( 2026, 2, 27 ) ), datetime( 2027, 2, 1 ) )
+
+class DaylightSavingTest( unittest.TestCase ):
+
+    def testSpringForwardGap( self ):
+        schedule = CronSchedule( '30 2 * * *' )
+        when = schedule.nextTime( datetime( 2026, 3, 8, 0, 0 ) )
+
+        # 2:30 does not exist that day; it runs an hour later instead
+        self.assertEqual( when, datetime( 2026, 3, 8, 2, 30 ) )
+        self.assertEqual( time.localtime( CronSchedule.toTimestamp( when ) )[ 3:5 ], ( 3, 30 ) )
+
+        self.assertEqual( schedule.nextTime( datetime.fromtimestamp( CronSchedule.toTimestamp( when ) ) ), datetime( 2026, 3, 9, 2, 30 ) )
+
+    def testSpringForwardHourly( self ):
+        schedule = CronSchedule( '0 * * * *' )
+        when = datetime( 2026, 3, 8, 0, 30 )
+        timestamps = []
+
+        for i in range( 4 ):
+            when = schedule.nextTime( datetime.fromtimestamp( CronSchedule.toTimestamp( when ) ) )
+            timestamps.append( CronSchedule.toTimestamp( when ) )
+
+        self.assertEqual( [ time.localtime( timestamp )[3] for timestamp in timestamps ], [ 1, 3, 4, 5 ] )
+
+    def testFallBackOverlapFiresOnce( self ):
+        schedule = CronSchedule( '30 1 * * *' )
+        when = schedule.nextTime( datetime( 2026, 10, 31, 12, 0 ) )
+        self.assertEqual( when, datetime( 2026, 11, 1, 1, 30 ) )
+
+        # 1:30 happens twice that day, but the next run is the day after
+        self.assertEqual( schedule.nextTime( datetime.fromtimestamp( CronSchedule.toTimestamp( when ) ) ), datetime( 2026, 11, 2, 1, 30 ) )
+
+    def testFallBackHourly( self ):
+        schedule = CronSchedule( '0 * * * *' )
+        when = datetime( 2026, 11, 1, 0, 30 )
+        timestamps = []
+
+        for i in range( 4 ):
+            when = schedule.nextTime( datetime.fromtimestamp( CronSchedule.toTimestamp( when ) ) )
+            timestamps.append( CronSchedule.toTimestamp( when ) )
+
+        self.assertEqual( [ time.localtime( timestamp )[3] for timestamp in timestamps ], [ 1, 2, 3, 4 ] )
+        self.assertEqual( timestamps, sorted( set( timestamps ) ) )
+
+if __name__ == '__main__':
+    unittest.main()
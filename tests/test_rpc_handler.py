@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+from twisted.words.protocols.jabber import jid, xmlstream
+from twisted.words.xish import domish
+from twisted.words.xish.xmlstream import XmlStreamFactoryMixin
+from wokkel import subprotocols
+import datetime, unittest, xmlrpclib
+
+from common import CommonClientManager
+
+class TestClient( object ):
+    """
+    Just enough of a CommonClient for plugins to register their handlers
+    without connecting.
+    """
+
+    def __init__( self ):
+        self.user = 'bot'
+        self.domain = 'example.com'
+        self.resource = 'bot'
+        self.jid = jid.JID( 'bot@example.com/bot' )
+        self.factory = XmlStreamFactoryMixin()
+        self.factory.streamManager = subprotocols.StreamManager( self.factory )
+        self.custom_handlers = {}
+
+if CommonClientManager.common_client is None:
+    CommonClientManager.common_client = TestClient()
+
+from plugins.rpc_handler import paramsToElement, objectToElement, RPCDecoder, RPCExceptionInvalid, RPCProtocolHandler, FAULT_INVALID_PARAMS
+
+def parseElement( xml ):
+    elements = []
+
+    stream = domish.elementStream()
+    stream.DocumentStartEvent = lambda root: None
+    stream.ElementEvent = elements.append
+    stream.DocumentEndEvent = lambda: None
+    stream.parse( "<stream xmlns='jabber:client'>" + xml )
+
+    return elements[0]
+
+def decodeXml( xml, **limits ):
+    return RPCDecoder( **limits ).decodeParams( parseElement( xml ) )
+
+def wrapValue( value ):
+    return '<params><param><value>%s</value></param></params>' % value
+
+def loadsParams( params ):
+    return xmlrpclib.loads( '<methodResponse>%s</methodResponse>' % paramsToElement( params ).toXml().encode( 'utf-8' ) )[0]
+
+class EncoderTest( unittest.TestCase ):
+
+    def assertRoundTrip( self, params ):
+        self.assertEqual( loadsParams( params ), xmlrpclib.loads( xmlrpclib.dumps( params, allow_none = True ) )[0] )
+
+    def testNil( self ):
+        self.assertRoundTrip( ( None, ) )
+        self.assertEqual( loadsParams( ( None, ) ), ( None, ) )
+
+    def testBoolAndInt( self ):
+        self.assertRoundTrip( ( True, False, 0, 1, -1, 2**31 - 1, -2**31 ) )
+        self.assertEqual( [ type( value ) for value in loadsParams( ( True, 1 ) ) ], [ bool, int ] )
+
+    def testIntOutOfRange( self ):
+        self.assertRaises( OverflowError, paramsToElement, ( 2**31, ) )
+        self.assertRaises( OverflowError, paramsToElement, ( -2**31 - 1, ) )
+
+    def testDouble( self ):
+        self.assertRoundTrip( ( 1.5, 0.1, -1e300 ) )
+
+    def testStrings( self ):
+        self.assertRoundTrip( ( '', 'plain', '<&>"\'', u'ünïcødé', u'日本' ) )
+
+    def testBinary( self ):
+        self.assertRoundTrip( ( xmlrpclib.Binary( '\x00\xff' * 50 ), xmlrpclib.Binary( '' ) ) )
+
+    def testDateTime( self ):
+        self.assertRoundTrip( ( xmlrpclib.DateTime( '20260101T10:00:00' ), datetime.datetime( 2026, 1, 2, 3, 4, 5 ) ) )
+
+    def testNested( self ):
+        self.assertRoundTrip( ( [], {}, (), [ 1, [ 2, [ 3, [ None ] ] ] ], { 'a': { 'b': [ { 'c': u'ü' } ] }, 'd': ( 1, 2 ) } ) )
+
+    def testInstance( self ):
+
+        class Item( object ):
+            def __init__( self ):
+                self.name = 'item'
+                self.tags = [ 'a', 'b' ]
+
+        self.assertRoundTrip( ( Item(), ) )
+
+    def testNonStringKey( self ):
+        self.assertRaises( TypeError, paramsToElement, ( { 1: 2 }, ) )
+
+    def testUnsupportedType( self ):
+        self.assertRaises( TypeError, paramsToElement, ( object(), ) )
+
+    def testCyclicList( self ):
+        cyclic = []
+        cyclic.append( cyclic )
+        self.assertRaises( TypeError, paramsToElement, ( cyclic, ) )
+
+    def testCyclicDict( self ):
+        cyclic = {}
+        cyclic[ 'self' ] = [ cyclic ]
+        self.assertRaises( TypeError, objectToElement, cyclic )
+
+    def testSharedNotCyclic( self ):
+        shared = [ 1, 2 ]
+        self.assertRoundTrip( ( [ shared, shared ], { 'a': shared, 'b': shared } ) )
+
+class DecoderTest( unittest.TestCase ):
+
+    def assertDecodesLikeXmlrpclib( self, params ):
+        xml = xmlrpclib.dumps( params, allow_none = True )
+        self.assertEqual( decodeXml( xml ), xmlrpclib.loads( xml )[0] )
+
+    def testMatchesXmlrpclib( self ):
+        self.assertDecodesLikeXmlrpclib( ( 1, -2**31, 'a', u'ünï', u'日本', '<&>', None, True, False, 1.5, 0.1 ) )
+        self.assertDecodesLikeXmlrpclib( ( xmlrpclib.Binary( '\x00\xff' * 20 ), xmlrpclib.DateTime( '20260101T10:00:00' ) ) )
+        self.assertDecodesLikeXmlrpclib( ( [], {}, [ 1, [ 2, [ 3 ] ] ], { 'k': { 'n': [ None, { 'x': 'y' } ] } } ) )
+
+    def testMatchesXmlrpclibTypes( self ):
+        xml = xmlrpclib.dumps( ( 'ascii', u'ünï', 1, True ) )
+        self.assertEqual( [ type( value ) for value in decodeXml( xml ) ], [ type( value ) for value in xmlrpclib.loads( xml )[0] ] )
+
+    def testUntypedValueIsString( self ):
+        self.assertEqual( decodeXml( wrapValue( 'untyped' ) ), ( 'untyped', ) )
+        self.assertEqual( decodeXml( wrapValue( '<i4> 7 </i4>' ) ), ( 7, ) )
+
+    def testNoParams( self ):
+        self.assertEqual( RPCDecoder().decodeParams( None ), () )
+
+    def assertRejected( self, xml, **limits ):
+        self.assertRaises( RPCExceptionInvalid, decodeXml, xml, **limits )
+
+    def testBadInt( self ):
+        self.assertRejected( wrapValue( '<int>x</int>' ) )
+        self.assertRejected( wrapValue( '<i4>1.5</i4>' ) )
+
+    def testBadDouble( self ):
+        self.assertRejected( wrapValue( '<double>one</double>' ) )
+
+    def testBadBoolean( self ):
+        self.assertRejected( wrapValue( '<boolean>2</boolean>' ) )
+
+    def testBadBase64( self ):
+        self.assertRejected( wrapValue( '<base64>not base64!</base64>' ) )
+
+    def testUnknownType( self ):
+        self.assertRejected( wrapValue( '<foo>1</foo>' ) )
+
+    def testExtraChildren( self ):
+        self.assertRejected( wrapValue( '<int>1</int><int>2</int>' ) )
+        self.assertRejected( wrapValue( '<int><b/></int>' ) )
+        self.assertRejected( '<params><bogus/></params>' )
+        self.assertRejected( '<params><param><value>1</value><value>2</value></param></params>' )
+        self.assertRejected( wrapValue( '<array><data><bogus/></data></array>' ) )
+        self.assertRejected( wrapValue( '<array><data/><data/></array>' ) )
+
+    def testBadStruct( self ):
+        self.assertRejected( wrapValue( '<struct><bogus/></struct>' ) )
+        self.assertRejected( wrapValue( '<struct><member><value><int>1</int></value></member></struct>' ) )
+        self.assertRejected( wrapValue( '<struct><member><name>a</name></member></struct>' ) )
+        self.assertRejected( wrapValue( '<struct><member><name>a</name><name>b</name><value>1</value></member></struct>' ) )
+
+    def testMaxDepth( self ):
+        nested = '<array><data><value>' * 5 + '1' + '</value></data></array>' * 5
+        self.assertEqual( decodeXml( wrapValue( nested ), max_depth = 5 ), ( [ [ [ [ [ '1' ] ] ] ] ], ) )
+        self.assertRejected( wrapValue( nested ), max_depth = 4 )
+
+        struct = '<struct><member><name>a</name><value>' * 3 + '1' + '</value></member></struct>' * 3
+        self.assertRejected( wrapValue( struct ), max_depth = 2 )
+
+    def testMaxValues( self ):
+        xml = xmlrpclib.dumps( ( range( 10 ), ) )
+        self.assertEqual( decodeXml( xml, max_values = 11 ), ( range( 10 ), ) )
+        self.assertRejected( xml, max_values = 10 )
+
+    def testMaxSize( self ):
+        xml = xmlrpclib.dumps( ( 'x' * 100, ) )
+        self.assertEqual( decodeXml( xml, max_size = 100 ), ( 'x' * 100, ) )
+        self.assertRejected( xml, max_size = 99 )
+
+class RecordingStream( xmlstream.XmlStream ):
+
+    def __init__( self ):
+        xmlstream.XmlStream.__init__( self, xmlstream.Authenticator() )
+        self.sent = []
+
+    def send( self, element ):
+        self.sent.append( element )
+
+class MethodCallTest( unittest.TestCase ):
+
+    def setUp( self ):
+        self.handler = RPCProtocolHandler( CommonClientManager.common_client )
+        self.handler.xmlstream = RecordingStream()
+        self.handler.subscribeMethod( 'test.echo', lambda iq, *params: list( params ) )
+
+    def tearDown( self ):
+        self.handler.unsubscribeMethod( 'test.echo' )
+
+    def call( self, params ):
+        self.handler.onMethodCall( parseElement( "<iq type='set' id='c1' from='peer@example.com/r'><query xmlns='jabber:iq:rpc'><methodName>test.echo</methodName>%s</query></iq>" % params ) )
+
+        self.assertEqual( len( self.handler.xmlstream.sent ), 1 )
+        response = self.handler.xmlstream.sent.pop()
+        self.assertEqual( ( response['id'], response['to'] ), ( 'c1', 'peer@example.com/r' ) )
+
+        return xmlrpclib.loads( '<?xml version="1.0"?>' + response.query.methodResponse.toXml().encode( 'utf-8' ) )[0]
+
+    def assertInvalidParams( self, params ):
+        try:
+            self.call( params )
+        except xmlrpclib.Fault, fault:
+            self.assertEqual( fault.faultCode, FAULT_INVALID_PARAMS )
+        else:
+            self.fail( 'no fault for %s' % params )
+
+    def testValidCall( self ):
+        self.assertEqual( self.call( xmlrpclib.dumps( ( 1, 'a' ) ) ), ( [ 1, 'a' ], ) )
+
+    def testInvalidParams( self ):
+        self.assertInvalidParams( wrapValue( '<int>x</int>' ) )
+        self.assertInvalidParams( wrapValue( '<double>one</double>' ) )
+        self.assertInvalidParams( wrapValue( '<foo>1</foo>' ) )
+        self.assertInvalidParams( wrapValue( '<int>1</int><int>2</int>' ) )
+        self.assertInvalidParams( wrapValue( '<struct><member><value>1</value></member></struct>' ) )
+
+    def testLimits( self ):
+        self.handler.max_depth = 2
+        self.assertInvalidParams( wrapValue( '<array><data><value>' * 3 + '1' + '</value></data></array>' * 3 ) )
+
+        self.handler.max_values = 5
+        self.assertInvalidParams( xmlrpclib.dumps( ( range( 10 ), ) ) )
+
+        self.handler.max_size = 10
+        self.assertInvalidParams( xmlrpclib.dumps( ( 'x' * 11, ) ) )
+
+if __name__ == '__main__':
+    unittest.main()